@@ -1,133 +1,698 @@
+import argparse
+import gzip
 import networkx as nx
+import numpy as np
 import matplotlib.pyplot as plt
 import sys
 import time
+from itertools import islice
+from multiprocessing import Pool
 
-# We need large recursion depth for whole genome assemble
-sys.setrecursionlimit(10000)
+# Bases are packed 2 bits each (A=0, C=1, G=2, T=3), anything else breaks the kmer
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+ENCODE = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b"ACGT"):
+    ENCODE[base] = code
+    ENCODE[base + 32] = code
+MAX_K = 32
+BATCH_BASES = 1 << 22
+SNAPSHOT_MAGIC = b'DBGRAPH2'
+SKETCH_WIDTH = 1 << 24
+SKETCH_DEPTH = 4
+SAMPLE_BASES = 1 << 24
+AUTO_K_VALUES = list(range(7, MAX_K + 1, 4))
+AUTO_K_TOLERANCE = 0.99
+BUBBLE_LENGTH_DIFFERENCE = 2
+BUBBLE_COVERAGE_RATIO = 2
+HASH_MULTIPLIERS = [0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93, 0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53]
 
-def create_de_bruijn_graph(sequences, k):
-    kmers = []
+class DeBruijnGraph:
+    # Nodes are the (k-1)-mers packed into uint64 values in the order the reads first show them, edges are kept in CSR arrays:
+    # the out edges of node v are targets[indptr[v]:indptr[v+1]], and dup holds the kmer multiplicity of each edge.
+    # After unitig compaction only the junction (k-1)-mers are left as nodes, and sequences holds the bases every edge
+    # appends after its source node; for a plain kmer graph that is just the last base of the target node.
+    # A canonical graph was counted on canonical kmers and holds both strands of every kmer with the same dup,
+    # so each component has a reverse complement mirror (or is its own mirror).
+    def __init__(self, k, nodes, indptr, targets, dup, sequences=None, canonical=False):
+        self.k = k
+        self.nodes = nodes
+        self.indptr = indptr
+        self.targets = targets
+        self.dup = dup
+        self.sequences = sequences
+        self.canonical = canonical
+
+    def number_of_nodes(self):
+        return len(self.nodes)
+
+    def number_of_edges(self):
+        return len(self.targets)
+
+    def out_degree(self):
+        return np.diff(self.indptr)
+
+    def in_degree(self):
+        return np.bincount(self.targets, minlength=len(self.nodes))
+
+    def sources(self):
+        return np.repeat(np.arange(len(self.nodes)), self.out_degree())
+
+    def node_label(self, node):
+        return decode_kmer(int(self.nodes[node]), self.k - 1)
+
+    def edge_sequences(self):
+        if self.sequences is not None:
+            return self.sequences
+        return BASES[(self.nodes[self.targets] & np.uint64(3)).astype(np.intp)].tobytes().decode()
+
+    def edge_lengths(self):
+        if self.sequences is None:
+            return np.ones(self.number_of_edges(), dtype=np.int64)
+        return np.fromiter(map(len, self.sequences), dtype=np.int64, count=self.number_of_edges())
+
+    def walk_to_sequence(self, start_node, edges):
+        # The start node gives k-1 bases, every edge of the walk appends its own bases
+        if self.sequences is None:
+            tail = BASES[(self.nodes[self.targets[np.asarray(edges, dtype=np.int64)]] & np.uint64(3)).astype(np.intp)].tobytes().decode()
+        else:
+            tail = ''.join(self.sequences[edge] for edge in edges)
+        return self.node_label(start_node) + tail
+
+    def subgraph(self, node_indices):
+        node_indices = np.sort(np.asarray(node_indices, dtype=np.int64))
+        starts = self.indptr[node_indices]
+        degrees = self.indptr[node_indices + 1] - starts
+        edge_ids = np.repeat(starts - np.cumsum(degrees) + degrees, degrees) + np.arange(degrees.sum())
+        sources = np.repeat(np.arange(len(node_indices)), degrees)
+        # Keep only the edges whose target is also inside the subgraph
+        targets = np.searchsorted(node_indices, self.targets[edge_ids])
+        keep = targets < len(node_indices)
+        keep[keep] = node_indices[targets[keep]] == self.targets[edge_ids[keep]]
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(sources[keep], minlength=len(node_indices)))))
+        sequences = self.sequences[edge_ids[keep]] if self.sequences is not None else None
+        return DeBruijnGraph(self.k, self.nodes[node_indices], indptr, targets[keep], self.dup[edge_ids[keep]], sequences, self.canonical)
+
+    def remove_edges(self, remove):
+        keep = ~remove
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(self.sources()[keep], minlength=len(self.nodes)))))
+        sequences = self.sequences[keep] if self.sequences is not None else None
+        return DeBruijnGraph(self.k, self.nodes, indptr, self.targets[keep], self.dup[keep], sequences, self.canonical)
+
+    def to_networkx(self):
+        # Export with string nodes and the "count"/"dup" edge attributes of the original graph format;
+        # unitig edges may run in parallel, so a compacted graph also carries the edge "sequence"
+        labels = [self.node_label(node) for node in range(len(self.nodes))]
+        graph = nx.DiGraph() if self.sequences is None else nx.MultiDiGraph()
+        graph.add_nodes_from(labels)
+        if self.sequences is None:
+            for source, target, dup in zip(self.sources().tolist(), self.targets.tolist(), self.dup.tolist()):
+                graph.add_edge(labels[source], labels[target], count=1, dup=dup)
+        else:
+            for source, target, dup, sequence in zip(self.sources().tolist(), self.targets.tolist(), self.dup.tolist(), self.sequences):
+                graph.add_edge(labels[source], labels[target], count=1, dup=dup, sequence=sequence)
+        return graph
+
+def decode_kmer(value, length):
+    return ''.join("ACGT"[(value >> (2 * (length - 1 - i))) & 3] for i in range(length))
+
+def reverse_complement_kmers(values, length):
+    # Complementing a packed base is xor 3; the 2 bit bases are then reversed by swapping pairs, nibbles and bytes
+    values = values ^ np.uint64(0xFFFFFFFFFFFFFFFF)
+    values = ((values >> np.uint64(2)) & np.uint64(0x3333333333333333)) | ((values & np.uint64(0x3333333333333333)) << np.uint64(2))
+    values = ((values >> np.uint64(4)) & np.uint64(0x0F0F0F0F0F0F0F0F)) | ((values & np.uint64(0x0F0F0F0F0F0F0F0F)) << np.uint64(4))
+    return values.byteswap() >> np.uint64(64 - 2 * length)
+
+def canonical_kmers(values, k):
+    return np.minimum(values, reverse_complement_kmers(values, k))
+
+def batch_kmers(batch, k):
+    # Join the reads with a separator so no kmer spans two reads, then roll the packed values over the whole batch;
+    # the positions of the kmers in the joined batch come along
+    codes = ENCODE[np.frombuffer('N'.join(batch).encode(), dtype=np.uint8)]
+    if len(codes) < k:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = invalid[k:] - invalid[:-k] == 0
+    codes = np.where(codes == 4, 0, codes).astype(np.uint64)
+    values = np.zeros(len(codes) - k + 1, dtype=np.uint64)
+    for i in range(k):
+        values = (values << np.uint64(2)) | codes[i:i + len(values)]
+    return values[valid], np.flatnonzero(valid)
+
+def merge_counts(kmer_arrays, count_arrays, first_arrays):
+    kmers = np.concatenate(kmer_arrays)
+    counts = np.concatenate(count_arrays)
+    first = np.concatenate(first_arrays)
+    order = np.argsort(kmers, kind='stable')
+    kmers = kmers[order]
+    if len(kmers) == 0:
+        return kmers, counts, first
+    starts = np.flatnonzero(np.concatenate(([True], kmers[1:] != kmers[:-1])))
+    return kmers[starts], np.add.reduceat(counts[order], starts), np.minimum.reduceat(first[order], starts)
+
+def read_fastq(fastq_file, batch_bases=BATCH_BASES):
+    # Stream the reads in batches of about batch_bases bases; gzip and bgzip input is recognised by its magic number
+    with open(fastq_file, 'rb') as file:
+        compressed = file.read(2) == b'\x1f\x8b'
+    with (gzip.open(fastq_file, 'rt') if compressed else open(fastq_file, 'r')) as file:
+        batch, batch_size = [], 0
+        for line in islice(file, 1, None, 4):
+            sequence = line.rstrip()
+            batch.append(sequence)
+            batch_size += len(sequence)
+            if batch_size >= batch_bases:
+                yield batch
+                batch, batch_size = [], 0
+        if len(batch) > 0:
+            yield batch
+
+def batch_sequences(sequences, batch_bases=BATCH_BASES):
+    # Group reads which are already in memory the same way read_fastq does
+    batch, batch_size = [], 0
     for sequence in sequences:
-        kmers = kmers + [sequence[i:i+k] for i in range(len(sequence) - k + 1)]
-    
-    # Remove duplicated kmers
-    # unique_kmers = set(kmers)
-    # kmers = list(unique_kmers)
-    # print(len(kmers))
-    graph = nx.DiGraph()
-    for kmer in kmers:
-        prefix = kmer[:-1]
-        suffix = kmer[1:]
-        # We use "count" to mark the edge for DFS, "dup" to calculate the duplication of kmers
-        if graph.has_edge(prefix, suffix):
-            graph[prefix][suffix]['dup'] += 1
+        batch.append(sequence)
+        batch_size += len(sequence)
+        if batch_size >= batch_bases:
+            yield batch
+            batch, batch_size = [], 0
+    if len(batch) > 0:
+        yield batch
+
+class CountMinSketch:
+    # Approximate kmer counts in a fixed amount of memory: each row hashes a kmer to one saturating uint8 counter,
+    # and the smallest of its counters is an upper bound of how often the kmer was seen
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.bits = int(width).bit_length() - 1
+        self.counters = np.zeros((depth, 1 << self.bits), dtype=np.uint8)
+        self.multipliers = np.array(HASH_MULTIPLIERS[:depth], dtype=np.uint64)
+
+    def indices(self, row, values):
+        # Multiply-shift hashing of the mixed kmer values
+        mixed = values ^ (values >> np.uint64(31))
+        return ((mixed * self.multipliers[row]) >> np.uint64(64 - self.bits)).astype(np.intp)
+
+    def add(self, values):
+        for row in range(len(self.counters)):
+            index, count = np.unique(self.indices(row, values), return_counts=True)
+            self.counters[row, index] = np.minimum(self.counters[row, index] + count, 255)
+
+    def estimate(self, values):
+        estimate = np.full(len(values), 255, dtype=np.uint8)
+        for row in range(len(self.counters)):
+            np.minimum(estimate, self.counters[row, self.indices(row, values)], out=estimate)
+        return estimate
+
+def sketch_kmers(batches, k, width=SKETCH_WIDTH, canonical=False):
+    # First pass of the two pass counting mode: only the sketch is kept in memory
+    sketch = CountMinSketch(width)
+    for batch in batches:
+        values = batch_kmers(batch, k)[0]
+        sketch.add(canonical_kmers(values, k) if canonical else values)
+    return sketch
+
+def count_kmers(batches, k, min_count=1, sketch=None, canonical=False):
+    # Count the kmers batch by batch; batch results are merged into the totals once they outgrow them,
+    # so the merging cost stays linear in the number of distinct kmers. With a sketch from a first pass,
+    # kmers which can not reach min_count are dropped before they are ever stored. In canonical mode a kmer
+    # and its reverse complement are counted together under the smaller of the two. Every kmer also keeps the
+    # position of its first occurrence in the whole read stream
+    kmers, counts, first = np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pending_kmers, pending_counts, pending_first = [], [], []
+    pending_size = 0
+    offset = 0
+    for batch in batches:
+        values, positions = batch_kmers(batch, k)
+        if canonical:
+            values = canonical_kmers(values, k)
+        if sketch is not None:
+            # A saturated counter stands for any count from 255 up, so those kmers are always kept for the exact count
+            keep = sketch.estimate(values) >= min(min_count, 255)
+            values, positions = values[keep], positions[keep]
+        batch_kmer, batch_first, batch_count = np.unique(values, return_index=True, return_counts=True)
+        pending_kmers.append(batch_kmer)
+        pending_counts.append(batch_count)
+        pending_first.append(offset + positions[batch_first])
+        pending_size += len(batch_kmer)
+        offset += sum(len(sequence) + 1 for sequence in batch)
+        if pending_size >= len(kmers):
+            kmers, counts, first = merge_counts([kmers] + pending_kmers, [counts] + pending_counts, [first] + pending_first)
+            pending_kmers, pending_counts, pending_first, pending_size = [], [], [], 0
+    kmers, counts, first = merge_counts([kmers] + pending_kmers, [counts] + pending_counts, [first] + pending_first)
+    # The exact counts settle whatever the sketch overestimated
+    solid = counts >= min_count
+    return kmers[solid], counts[solid], first[solid]
+
+def sample_batches(batches, sample_bases=SAMPLE_BASES):
+    # Keep reads from the start of the stream until about sample_bases bases are in memory
+    sample, sample_size = [], 0
+    for batch in batches:
+        sample.append(batch)
+        sample_size += sum(len(sequence) for sequence in batch)
+        if sample_size >= sample_bases:
+            break
+    return sample
+
+def kmer_spectra(batches, k_values, canonical=False):
+    # Abundance histogram of every kmer length: spectrum[c] is the number of distinct kmers seen c times.
+    # The batches are read once and kept, so they should be a sample and not the whole data set
+    batches = list(batches)
+    return {k: np.bincount(count_kmers(batches, k, canonical=canonical)[1]) for k in k_values}
+
+def solid_threshold(spectrum):
+    # The error kmers fall off from count 1 until the valley before the genomic coverage peak;
+    # a spectrum without a valley has no peak to separate and every kmer is kept
+    rising = np.flatnonzero(spectrum[1:-1] < spectrum[2:])
+    return int(rising[0]) + 1 if len(rising) > 0 else 1
+
+def select_k(spectra, tolerance=AUTO_K_TOLERANCE):
+    # Count the distinct kmers above the valley for every length: short kmers collapse repeats and long kmers lose
+    # coverage until the genomic peak sinks into the errors. The longest kmer keeping nearly the most of them
+    # is picked, as it resolves the most repeats in the graph
+    solid_kmers = {k: int(spectrum[solid_threshold(spectrum):].sum()) for k, spectrum in spectra.items()}
+    most = max(solid_kmers.values())
+    return max(k for k, solid in solid_kmers.items() if solid >= tolerance * most)
+
+def create_de_bruijn_graph(batches, k, min_count=1, sketch=None, canonical=False):
+    # batches is an iterable of read lists, as yielded by read_fastq or batch_sequences, or a plain list of reads;
+    # only kmers seen at least min_count times become edges
+    if not 2 <= k <= MAX_K:
+        raise ValueError(f"kmer length must be between 2 and {MAX_K}")
+    if isinstance(batches, str):
+        raise TypeError("create_de_bruijn_graph takes a list of reads or an iterable of read batches, not a single string")
+    if isinstance(batches, (list, tuple)) and any(isinstance(sequence, str) for sequence in batches):
+        batches = batch_sequences(batches)
+    kmers, dup, first = count_kmers(batches, k, min_count, sketch, canonical)
+    if canonical:
+        # Both strands of every canonical kmer become edges with the combined count (palindromes only once)
+        kmers, index = np.unique(np.concatenate((kmers, reverse_complement_kmers(kmers, k))), return_index=True)
+        dup = np.concatenate((dup, dup))[index]
+        first = np.concatenate((first, first))[index]
+    prefixes = kmers >> np.uint64(2)
+    suffixes = kmers & np.uint64((1 << (2 * (k - 1))) - 1)
+    values, inverse = np.unique(np.concatenate((prefixes, suffixes)), return_inverse=True)
+    # Number the nodes and order the out edges as the reads first show them, the way the networkx graph was built
+    # kmer by kmer (prefix node, then suffix node), so the traversals meet nodes and edges in the same order
+    appearance = np.full(len(values), np.iinfo(np.int64).max)
+    np.minimum.at(appearance, inverse, np.concatenate((2 * first, 2 * first + 1)))
+    node_order = np.argsort(appearance, kind='stable')
+    rank = np.empty(len(values), dtype=np.int64)
+    rank[node_order] = np.arange(len(values))
+    nodes = values[node_order]
+    sources = rank[inverse[:len(kmers)]]
+    targets = rank[inverse[len(kmers):]]
+    edge_order = np.lexsort((first, sources))
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=len(nodes)))))
+    return DeBruijnGraph(k, nodes, indptr, targets[edge_order], dup[edge_order].astype(np.uint32), canonical=canonical)
+
+def save_graph(graph, graph_file):
+    if graph.sequences is not None:
+        raise ValueError("only plain kmer graphs can be saved, save the graph before simplify_graph")
+    # Binary snapshot: a magic string and (k, nodes, edges, canonical) header followed by the raw little endian arrays,
+    # each one starting on an 8 byte boundary so load_graph can memory map them
+    with open(graph_file, 'wb') as file:
+        file.write(SNAPSHOT_MAGIC)
+        np.array([graph.k, graph.number_of_nodes(), graph.number_of_edges(), graph.canonical], dtype='<i8').tofile(file)
+        np.asarray(graph.nodes, dtype='<u8').tofile(file)
+        np.asarray(graph.indptr, dtype='<i8').tofile(file)
+        np.asarray(graph.targets, dtype='<i8').tofile(file)
+        np.asarray(graph.dup, dtype='<u4').tofile(file)
+
+def load_graph(graph_file, mmap=True):
+    with open(graph_file, 'rb') as file:
+        if file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{graph_file} is not a de bruijn graph snapshot")
+        k, number_of_nodes, number_of_edges, canonical = np.fromfile(file, dtype='<i8', count=4).tolist()
+    arrays = []
+    offset = len(SNAPSHOT_MAGIC) + 4 * 8
+    for dtype, length in (('<u8', number_of_nodes), ('<i8', number_of_nodes + 1), ('<i8', number_of_edges), ('<u4', number_of_edges)):
+        if mmap and length > 0:
+            arrays.append(np.memmap(graph_file, dtype=dtype, mode='r', offset=offset, shape=(length,)))
         else:
-            graph.add_edge(prefix, suffix, count=1, dup=1)
+            arrays.append(np.fromfile(graph_file, dtype=dtype, count=length, offset=offset))
+        offset += length * np.dtype(dtype).itemsize
+    return DeBruijnGraph(k, *arrays, canonical=bool(canonical))
+
+def weakly_connected_components(graph):
+    # Vectorized hook-and-shortcut union find: every root is hooked onto the smallest neighbouring root,
+    # then the labels are compressed by pointer jumping until each node points at its root
+    if graph.number_of_nodes() == 0:
+        return []
+    labels = np.arange(graph.number_of_nodes())
+    sources, targets = graph.sources(), graph.targets
+    while True:
+        low = np.minimum(labels[sources], labels[targets])
+        high = np.maximum(labels[sources], labels[targets])
+        if np.array_equal(low, high):
+            break
+        np.minimum.at(labels, high, low)
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+    order = np.argsort(labels, kind='stable')
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+    return np.split(order, boundaries)
+
+def strand_representatives(graph, components):
+    # The mirror of a component holds the reverse complements of its nodes; keep the one with the smaller node
+    if not graph.canonical:
+        return components
+    representatives = []
+    for component in components:
+        nodes = graph.nodes[component]
+        if nodes.min() <= reverse_complement_kmers(nodes, graph.k - 1).min():
+            representatives.append(component)
+    return representatives
+
+def compact_unitigs(graph):
+    # Collapse every non-branching path into one edge carrying the bases of the whole unitig,
+    # its dup becomes the length weighted mean duplication of the edges it replaces
+    indptr, targets, sources = graph.indptr.tolist(), graph.targets.tolist(), graph.sources().tolist()
+    sequences, lengths, dup = graph.edge_sequences(), graph.edge_lengths().tolist(), graph.dup.tolist()
+    internal = ((graph.in_degree() == 1) & (graph.out_degree() == 1)).tolist()
+    visited = [False] * len(targets)
+    unitig_sources, unitig_targets, unitig_sequences, unitig_dup = [], [], [], []
+    def follow(edge):
+        unitig_sources.append(sources[edge])
+        parts, length, weight = [], 0, 0
+        while True:
+            visited[edge] = True
+            parts.append(sequences[edge])
+            length += lengths[edge]
+            weight += dup[edge] * lengths[edge]
+            node = targets[edge]
+            if not internal[node] or visited[indptr[node]]:
+                break
+            edge = indptr[node]
+        unitig_targets.append(node)
+        unitig_sequences.append(''.join(parts))
+        unitig_dup.append(max(1, round(weight / length)))
+    for edge in range(len(targets)):
+        if not internal[sources[edge]]:
+            follow(edge)
+    # Whatever is left are circular unitigs without any junction
+    for edge in range(len(targets)):
+        if not visited[edge]:
+            follow(edge)
+
+    unitig_sources, unitig_targets = np.array(unitig_sources, dtype=np.int64), np.array(unitig_targets, dtype=np.int64)
+    junctions = np.unique(np.concatenate((unitig_sources, unitig_targets)))
+    order = np.argsort(unitig_sources, kind='stable')
+    unitig_sources = np.searchsorted(junctions, unitig_sources[order])
+    unitig_targets = np.searchsorted(junctions, unitig_targets[order])
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(unitig_sources, minlength=len(junctions)))))
+    unitig_sequences = np.array(unitig_sequences + [None], dtype=object)[:-1][order]
+    return DeBruijnGraph(graph.k, graph.nodes[junctions], indptr, unitig_targets, np.array(unitig_dup, dtype=np.uint32)[order], unitig_sequences, graph.canonical)
+
+def tip_edges(graph, max_length):
+    # A tip is a short unitig hanging from a dead end onto a junction where a better supported edge comes in (or goes out)
+    sources, targets, dup = graph.sources(), graph.targets, graph.dup
+    in_degree, out_degree = graph.in_degree(), graph.out_degree()
+    best_in = np.zeros(graph.number_of_nodes(), dtype=graph.dup.dtype)
+    np.maximum.at(best_in, targets, dup)
+    best_out = np.zeros(graph.number_of_nodes(), dtype=graph.dup.dtype)
+    np.maximum.at(best_out, sources, dup)
+    entering = (in_degree[sources] == 0) & (out_degree[sources] == 1) & (in_degree[targets] > 1) & (dup < best_in[targets])
+    leaving = (out_degree[targets] == 0) & (in_degree[targets] == 1) & (out_degree[sources] > 1) & (dup < best_out[sources])
+    return (entering | leaving) & (graph.edge_lengths() <= max_length)
+
+def bubble_edges(graph, max_length):
+    # Unitigs running in parallel between the same two junctions form a bubble when they are about as long, as a
+    # sequencing error or a SNP leaves them; the ones with a fraction of the support of the best are popped.
+    # A parallel unitig of a different length is real sequence (e.g. a repeat copy) and is kept
+    sources, targets, dup, lengths = graph.sources(), graph.targets, graph.dup.astype(np.int64), graph.edge_lengths()
+    order = np.lexsort((-dup, targets, sources))
+    first = np.ones(graph.number_of_edges(), dtype=bool)
+    first[1:] = (sources[order][1:] != sources[order][:-1]) | (targets[order][1:] != targets[order][:-1])
+    best = order[np.flatnonzero(first)][np.cumsum(first) - 1]
+    remove = np.zeros(graph.number_of_edges(), dtype=bool)
+    remove[order] = (BUBBLE_COVERAGE_RATIO * dup[order] <= dup[best]) & (np.abs(lengths[order] - lengths[best]) <= BUBBLE_LENGTH_DIFFERENCE)
+    return remove & (lengths <= max_length)
+
+def simplify_graph(graph, max_tip_length=None, max_bubble_length=None):
+    # Removing tips and bubbles turns more junctions into plain path nodes, so compact again and repeat until nothing changes
+    max_tip_length = 2 * graph.k if max_tip_length is None else max_tip_length
+    max_bubble_length = 2 * graph.k if max_bubble_length is None else max_bubble_length
+    graph = compact_unitigs(graph)
+    while graph.number_of_edges() > 0:
+        remove = tip_edges(graph, max_tip_length) | bubble_edges(graph, max_bubble_length)
+        if not remove.any():
+            break
+        graph = compact_unitigs(graph.remove_edges(remove))
     return graph
 
 def find_start_node(graph):
-    start_nodes = [node for node in graph.nodes() if graph.in_degree(node) == 0 and graph.out_degree(node) > 0]
+    in_degree, out_degree = graph.in_degree(), graph.out_degree()
+    start_nodes = np.flatnonzero((in_degree == 0) & (out_degree > 0)).tolist()
     # If we can not find the start node, then we arbitraryly set one of the nodes which has the max out degree as start node
     if len(start_nodes) == 0:
-        start_nodes = [max(graph.nodes(), key=graph.out_degree)]
+        start_nodes = [int(np.argmax(out_degree))]
     return start_nodes
 
+def edge_multiplicity(graph):
+    # Repeated regions are sequenced more often, so the copy number of every edge is estimated by dividing
+    # its duplication by the coverage of a typical sequenced base (the dup weighted median of the graph)
+    if graph.number_of_edges() == 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.argsort(graph.dup)
+    cumulative = np.cumsum(graph.dup[order] * graph.edge_lengths()[order], dtype=np.float64)
+    coverage = graph.dup[order][np.searchsorted(cumulative, cumulative[-1] / 2)]
+    return np.maximum(1, np.rint(graph.dup / coverage)).astype(np.int64)
+
 def find_eulerian_path(graph):
-    # Using DFS to find eulerian path
-    def dfs(node, circuit=[]):
-        nonlocal circuit_long
-        circuit = circuit + [node]
-        if len(circuit) > len(circuit_long):
-            circuit_long = circuit
-        successors = list(graph.successors(node))
-        for successor in successors:
-            if graph[node][successor]['count'] == 1:
-                graph[node][successor]['count'] = 0
-                dfs(successor, circuit.copy())
-
-    # Perform DFS to find the Eulerian path
-    max_circuit = []
+    # Iterative DFS from every start node: each edge is walked once per start, the out edges of a node are taken
+    # in graph order, and the deepest walk in bases is kept (the first one found on ties)
+    if graph.number_of_edges() == 0:
+        return graph.node_label(0) if graph.number_of_nodes() > 0 else ''
+    indptr, targets = graph.indptr.tolist(), graph.targets.tolist()
+    lengths = graph.edge_lengths().tolist()
     start_nodes = find_start_node(graph)
+    max_walk, max_length, max_start = [], 0, start_nodes[0]
+    next_edge = indptr[:-1]
     for start_node in start_nodes:
-        circuit_long = []
-        dfs(start_node)
-        if len(circuit_long) > len(max_circuit):
-            max_circuit = circuit_long
-        edges = graph.edges()
-        for edge in edges:
-            source, target = edge
-            graph[source][target]['count'] = 1
+        # Edges are used up in order, so next_edge[node] is the first unused out edge; only the visited nodes are reset
+        visited = [start_node]
+        node_stack, walk, walk_length = [start_node], [], 0
+        deepest = False
+        while True:
+            node = node_stack[-1]
+            edge = next_edge[node]
+            if edge < indptr[node + 1]:
+                next_edge[node] = edge + 1
+                node = targets[edge]
+                visited.append(node)
+                node_stack.append(node)
+                walk.append(edge)
+                walk_length += lengths[edge]
+                if walk_length > max_length:
+                    max_length, max_start, deepest = walk_length, start_node, True
+                continue
+            # Any step after a new maximum is deeper still, so the deepest walk is copied once at the first step back
+            if deepest:
+                max_walk, deepest = walk.copy(), False
+            if len(walk) == 0:
+                break
+            node_stack.pop()
+            walk_length -= lengths[walk.pop()]
+        for node in visited:
+            next_edge[node] = indptr[node]
     # Assemble the genome
-    assembled_genome = max_circuit[0] + ''.join([s[-1] for s in max_circuit[1:]])
-    return assembled_genome
+    return graph.walk_to_sequence(max_start, max_walk)
+
+def find_hierholzer_path(graph):
+    # Iterative Hierholzer: every edge is walked as many times as its estimated copy number
+    if graph.number_of_edges() == 0:
+        return graph.node_label(0) if graph.number_of_nodes() > 0 else ''
+    indptr, targets, sources = graph.indptr.tolist(), graph.targets.tolist(), graph.sources().tolist()
+    lengths = graph.edge_lengths().tolist()
+    multiplicity = edge_multiplicity(graph)
+    remaining = multiplicity.tolist()
+    # The out edges of each node are tried in decreasing dup order, so the walk follows the best supported kmers
+    edge_order = np.lexsort((-graph.dup.astype(np.int64), graph.sources())).tolist()
+    next_edge = indptr[:-1]
+    # Start from the nodes with more outgoing than incoming walks, best supported first, then pick up whatever cycles are left
+    surplus = np.bincount(graph.sources(), weights=multiplicity, minlength=graph.number_of_nodes())
+    surplus -= np.bincount(graph.targets, weights=multiplicity, minlength=graph.number_of_nodes())
+    support = np.zeros(graph.number_of_nodes(), dtype=np.int64)
+    np.maximum.at(support, graph.sources(), graph.dup)
+    order = np.lexsort((-support, -surplus))
+    start_nodes = order[surplus[order] > 0].tolist() + list(range(graph.number_of_nodes()))
+
+    # Each walk is kept as a tree of steps: step_node[i] is entered through step_edge[i] from step step_prev[i].
+    # If the graph is not Eulerian the reversed pop order jumps wherever a node was not entered from its predecessor;
+    # that step is then linked to the walk's latest step at the real source node. A trail which got stuck because
+    # an earlier walk used up the edges of its last node carries on along that earlier walk, so step_height[i] is
+    # the number of bases that can still be assembled after step i and step_next[i] is the step to continue with.
+    step_node, step_edge, step_prev, step_height, step_next = [], [], [], [], []
+    best_step = {}
+    for start_node in start_nodes:
+        stack = [(start_node, -1)]
+        circuit = []
+        while stack:
+            node = stack[-1][0]
+            position = next_edge[node]
+            while position < indptr[node + 1] and remaining[edge_order[position]] == 0:
+                position += 1
+            next_edge[node] = position
+            if position < indptr[node + 1]:
+                edge = edge_order[position]
+                remaining[edge] -= 1
+                stack.append((targets[edge], edge))
+            else:
+                circuit.append(stack.pop())
+        if len(circuit) < 2:
+            continue
+        first_step = len(step_node)
+        last_step = {}
+        trail_ends = set()
+        previous = -1
+        for node, edge in reversed(circuit):
+            if edge >= 0 and step_node[previous] != sources[edge]:
+                trail_ends.add(previous)
+                previous = last_step[sources[edge]]
+            step_node.append(node)
+            step_edge.append(edge)
+            step_prev.append(previous)
+            step_height.append(0)
+            step_next.append(-1)
+            previous = last_step[node] = len(step_node) - 1
+        trail_ends.add(previous)
+        for step in range(len(step_node) - 1, first_step - 1, -1):
+            if step in trail_ends and step_node[step] in best_step:
+                join = best_step[step_node[step]]
+                if step_height[join] > step_height[step]:
+                    step_height[step] = step_height[join]
+                    step_next[step] = step_next[join]
+            previous = step_prev[step]
+            if previous >= 0 and step_height[step] + lengths[step_edge[step]] > step_height[previous]:
+                step_height[previous] = step_height[step] + lengths[step_edge[step]]
+                step_next[previous] = step
+        for step in range(first_step, len(step_node)):
+            node = step_node[step]
+            if node not in best_step or step_height[step] > step_height[best_step[node]]:
+                best_step[node] = step
+    if len(step_node) == 0:
+        return graph.node_label(0)
+
+    # Assemble the genome from the walk start with the most bases ahead of it
+    step = max((step for step in range(len(step_node)) if step_prev[step] < 0), key=step_height.__getitem__)
+    start_node = step_node[step]
+    max_walk = []
+    step = step_next[step]
+    while step >= 0:
+        max_walk.append(step_edge[step])
+        step = step_next[step]
+    return graph.walk_to_sequence(start_node, max_walk)
 
 def find_weight_path(graph):
+    if graph.number_of_edges() == 0:
+        return graph.node_label(0) if graph.number_of_nodes() > 0 else ''
+    indptr, targets, dup = graph.indptr.tolist(), graph.targets.tolist(), graph.dup.tolist()
+    lengths = graph.edge_lengths().tolist()
     # Find the weighted path using Kmer duplications
-    def add_successor(node):
-        nonlocal circuit
-        circuit = circuit + [node]
-        successors = list(graph.successors(node))
-        valid_nodes = [x for x in successors if graph[node][x]['count'] == 1]
-        if len(valid_nodes) > 0:
-            successor = max(valid_nodes, key=lambda x: graph[node][x]['dup'])
-            graph[node][successor]['count'] = 0
-            add_successor(successor)
-    
     start_nodes = find_start_node(graph)
-    circuit_long = []
+    walk_long, walk_long_length, walk_long_start = [], -1, start_nodes[0]
     for start_node in start_nodes:
-        circuit = []
-        add_successor(start_node)
-        if len(circuit) > len(circuit_long):
-            circuit_long = circuit
-        edges = graph.edges()
-        for edge in edges:
-            source, target = edge
-            graph[source][target]['count'] = 1
+        count = [1] * len(targets)
+        walk, walk_length = [], 0
+        node = start_node
+        while True:
+            valid_edges = [edge for edge in range(indptr[node], indptr[node + 1]) if count[edge] == 1]
+            if len(valid_edges) == 0:
+                break
+            edge = max(valid_edges, key=lambda x: dup[x])
+            count[edge] = 0
+            node = targets[edge]
+            walk.append(edge)
+            walk_length += lengths[edge]
+        if walk_length > walk_long_length:
+            walk_long, walk_long_length, walk_long_start = walk, walk_length, start_node
     # Assemble the genome
-    assembled_genome = circuit_long[0] + ''.join([s[-1] for s in circuit_long[1:]])
-    return assembled_genome
+    return graph.walk_to_sequence(walk_long_start, walk_long)
 
 def visualize_graph(graph):
+    graph = graph.to_networkx()
     pos = nx.spring_layout(graph)
     nx.draw(graph, pos, with_labels=True, font_weight='bold', node_size=700, node_color='skyblue', font_size=8)
     plt.show()
 
 # Example usage
 #sequences = ["AAGATTCTCTAC", "TCTACGA"]
+#de_bruijn_graph = create_de_bruijn_graph(sequences, 5)
 
-if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python genome_assemble.py <input fastq file> <kmer length>. \nThe de bruijn graph will be saved as 'graph.graphml'.\nTo directly visualize the graph, modify the sentence '#visualize_graph(de_bruijn_graph)'.\nTo use weight algorithm instead of DFS, modify the sentence '#assembled_contig = find_weight_path(component_graph)'.")
-        sys.exit(1)
-    fastq_file = sys.argv[1]
-    k_value = int(sys.argv[2])
+def assemble_components(graph, components, workers=1, find_path=find_eulerian_path):
+    # Components are independent, so the pool gets them largest first and every contig is yielded as soon as it is done.
+    # Each worker only receives the compact arrays of its own component.
+    if workers <= 1:
+        for component in components:
+            yield find_path(graph.subgraph(component))
+        return
+    components = sorted(components, key=len, reverse=True)
+    component_graphs = (graph.subgraph(component) for component in components)
+    with Pool(workers) as pool:
+        for assembled_contig in pool.imap_unordered(find_path, component_graphs):
+            yield assembled_contig
 
-    with open(fastq_file,"r") as file:
-        lines = file.readlines()
-        sequences = lines[1::4]
-        file.close()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="De Bruijn graph genome assembler.", epilog="To directly visualize the graph, modify the sentence '#visualize_graph(de_bruijn_graph)'.")
+    parser.add_argument('fastq_file', type=str, nargs='?', help='Input fastq file, plain or gzip/bgzip compressed')
+    parser.add_argument('k_value', type=int, nargs='?', help='Kmer length (2 to {})'.format(MAX_K))
+    parser.add_argument('--auto-k', action='store_true', help='Choose the kmer length from the kmer spectra of a sample of the reads instead of giving k_value')
+    parser.add_argument('--sample-bases', type=int, default=SAMPLE_BASES, help='Bases sampled from the start of the fastq file by --auto-k (default: {})'.format(SAMPLE_BASES))
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of processes assembling connected components in parallel; contigs are printed as they finish (default: 1)')
+    parser.add_argument('-t', '--traversal', choices=['dfs', 'hierholzer', 'weight'], default='dfs', help='Contig traversal: deepest DFS walk using each edge once, Hierholzer walk repeating edges by their estimated copy number, or greedy walk along kmer duplications (default: dfs)')
+    parser.add_argument('--save-graph', type=str, help='Write a binary snapshot of the de bruijn graph to this file')
+    parser.add_argument('--load-graph', type=str, help='Assemble from a snapshot written by --save-graph instead of a fastq file')
+    parser.add_argument('--min-count', type=int, default=1, help='Only kmers seen at least this many times become graph edges; above 1 a count-min sketch pass over the reads drops the rare kmers before they are stored (default: 1)')
+    parser.add_argument('--sketch-width', type=int, default=SKETCH_WIDTH, help='Counters per row of the count-min sketch, rounded down to a power of two; the sketch takes {} bytes per counter (default: {})'.format(SKETCH_DEPTH, SKETCH_WIDTH))
+    parser.add_argument('--canonical', action='store_true', help='Count a kmer and its reverse complement as one, and print one contig per pair of reverse complement components')
+    parser.add_argument('--no-simplify', action='store_true', help='Traverse the raw kmer graph instead of the unitig graph with tips and bubbles removed')
+    parser.add_argument('--graphml', type=str, help="Also export the graph as GraphML to this file (e.g. 'graph.graphml')")
+    args = parser.parse_args()
+    if args.load_graph is None and (args.fastq_file is None or (args.k_value is None and not args.auto_k)):
+        parser.error("a fastq file and a kmer length (or --auto-k) are required unless --load-graph is given")
+    if args.min_count < 1:
+        parser.error("--min-count must be at least 1")
+    fastq_file = args.fastq_file
+    k_value = args.k_value
 
     start_time1 = time.time()
-    de_bruijn_graph = create_de_bruijn_graph(sequences, k_value)
-    nx.write_graphml(de_bruijn_graph, "graph.graphml")
+    if args.load_graph is None and args.auto_k:
+        spectra = kmer_spectra(sample_batches(read_fastq(fastq_file), args.sample_bases), AUTO_K_VALUES, args.canonical)
+        k_value = select_k(spectra)
+        print(f"Selected kmer length: {k_value}")
+    if args.load_graph is None and not 2 <= k_value <= MAX_K:
+        print(f"The kmer length should be between 2 and {MAX_K}.")
+        sys.exit(1)
+
+    if args.load_graph is not None:
+        de_bruijn_graph = load_graph(args.load_graph)
+    else:
+        sketch = sketch_kmers(read_fastq(fastq_file), k_value, args.sketch_width, args.canonical) if args.min_count > 1 else None
+        de_bruijn_graph = create_de_bruijn_graph(read_fastq(fastq_file), k_value, args.min_count, sketch, args.canonical)
+    if args.save_graph is not None:
+        save_graph(de_bruijn_graph, args.save_graph)
+    if not args.no_simplify:
+        de_bruijn_graph = simplify_graph(de_bruijn_graph)
     end_time1 = time.time()
     elapsed_time1 = end_time1 - start_time1
     print(f"{elapsed_time1} second")
+    if args.graphml is not None:
+        nx.write_graphml(de_bruijn_graph.to_networkx(), args.graphml)
 
     start_time2 = time.time()
-    assembled_genomes = []
-    weakly_connected_components = list(nx.weakly_connected_components(de_bruijn_graph))
-    for i in range(len(weakly_connected_components)):
-        component_graph = de_bruijn_graph.subgraph(weakly_connected_components[i])
-        assembled_contig = find_eulerian_path(component_graph)
-        #assembled_contig = find_weight_path(component_graph)
-        assembled_genomes = assembled_genomes + [assembled_contig]
+    components = strand_representatives(de_bruijn_graph, weakly_connected_components(de_bruijn_graph))
+    find_path = {'dfs': find_eulerian_path, 'hierholzer': find_hierholzer_path, 'weight': find_weight_path}[args.traversal]
     print(f"Assembled Genome:")
-    sorted_list = sorted(assembled_genomes, key=len, reverse=True)
-    for s in sorted_list:
-        print(s)
+    if args.workers > 1:
+        for assembled_contig in assemble_components(de_bruijn_graph, components, args.workers, find_path):
+            print(assembled_contig, flush=True)
+    else:
+        assembled_genomes = list(assemble_components(de_bruijn_graph, components, find_path=find_path))
+        sorted_list = sorted(assembled_genomes, key=len, reverse=True)
+        for s in sorted_list:
+            print(s)
     end_time2 = time.time()
     elapsed_time2 = end_time2 - start_time2
     print(f"{elapsed_time2} second")
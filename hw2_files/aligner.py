@@ -1,82 +1,641 @@
 import argparse
+import os
+import numpy as np
+from collections import namedtuple
+from multiprocessing import Pool
 
-def needleman_wunsch(seq1_file, seq2_file, output, gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty):
-    # Initialize the alignment matrix
-    with open('{}'.format(seq1_file), 'r') as file:
-        lines = file.readlines()
-        anno1 = lines[0].replace("\n",'')
-        seq1 = lines[1].replace("\n",'')
-        file.close()
-    with open('{}'.format(seq2_file), 'r') as file:
-        lines = file.readlines()
-        anno2 = lines[0].replace("\n",'')
-        seq2 = lines[1].replace("\n",'')
-        file.close()
+LINEAR_SPACE_CELLS = 1 << 26
+BLOCK_CELLS = 1 << 20
+# Traceback events are kept as uint8 codes
+MATCH, DELETE, INSERT = 0, 1, 2
+# Gotoh cells also record whether their delete and insert gaps extend the gap of the cell before
+DELETE_EXTENDS, INSERT_EXTENDS = 4, 8
+UNREACHABLE = -(1 << 29)
+# Sides of the matrix where outer gaps can be unpenalized: the first row and column, and the last row and column
+FREE_START, FREE_END = 1, 2
+# Seeds are 2 bit packed kmers, anything but ACGT breaks them; seeds hitting the reference more often are repeats
+SEED_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b"ACGT"):
+    SEED_CODES[base] = code
+    SEED_CODES[base + 32] = code
+SEED_MAX_HITS = 16
+# Same fields as the Bio.pairwise2 alignments plot_assemble.py draws
+Alignment = namedtuple('Alignment', ['seqA', 'seqB', 'score', 'start', 'end'])
+
+def boundary_score(length, scoring):
+    # Score of the first row and column: a single gap of the given length, free with an unpenalized start
+    gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty, substitution = scoring
+    return 0 if unpenalized_start_end & FREE_START or length == 0 else affine_gap_penalty + (length - 1) * gap_penalty
+
+def fill_row(seq1, seq2, i, c0, c1, prev_scores, prev_events, left_score, left_event, scoring):
+    # Scores and events of row i between columns c0 and c1, from the row above and the cell in column c0;
+    # ties go to match, then delete, then insert. seq1 and seq2 are uint8 arrays, and the gaps are linear
+    gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty, substitution = scoring
     m, n = len(seq1), len(seq2)
-    alignment_matrix = [[0] * (n + 1) for _ in range(m + 1)]
-    event_matrix = [["m"] * (n + 1) for _ in range(m + 1)]
+    match = prev_scores[:-1] + substitution[seq1[i - 1]][seq2[c0:c1]]
+    delete = prev_scores[1:] + np.int32(gap_penalty)
+    if c1 == n and c1 > c0 and unpenalized_start_end & FREE_END:
+        delete[-1] -= gap_penalty
+    # With a constant insert gap g, H[j] = max(T[j], H[j-1] + g) is a running maximum of T[j] - j*g
+    insert_penalty = 0 if i == m and unpenalized_start_end & FREE_END else gap_penalty
+    offsets = np.arange(c1 - c0 + 1, dtype=np.int32) * np.int32(insert_penalty)
+    scores = np.empty(c1 - c0 + 1, dtype=np.int32)
+    scores[0] = left_score
+    np.maximum(match, delete, out=scores[1:])
+    scores = np.maximum.accumulate(scores - offsets) + offsets
+    insert = scores[:-1] + np.int32(insert_penalty)
+    events = np.empty(c1 - c0 + 1, dtype=np.uint8)
+    events[0] = left_event
+    events[1:] = np.where((match >= delete) & (match >= insert), MATCH, np.where(delete >= insert, DELETE, INSERT))
+    return scores, events
 
-    # Initialize the matrix with gap penalties
-    if affine_gap_penalty == 0:
-        affine_gap_penalty = gap_penalty
-    for i in range(m + 1):
-        alignment_matrix[i][0] = 0 if unpenalized_start_end or i == 0 else affine_gap_penalty + (i-1)*gap_penalty
-        event_matrix[i][0] = "d"
-    for j in range(n + 1):
-        alignment_matrix[0][j] = 0 if unpenalized_start_end or j == 0 else affine_gap_penalty + (j-1)*gap_penalty
-        event_matrix[0][j] = "i"
-    event_matrix[0][0] = "m"
-
-    # Fill in the alignment matrix
+def traceback_block(seq1, seq2, r0, r1, c0, c1, top_scores, top_events, left_scores, left_events, scoring):
+    # Fill the whole block into a uint8 event matrix and follow the events back from its bottom right
+    # to its top left corner; returns the path and the score of the bottom right cell
+    event_matrix = np.empty((r1 - r0 + 1, c1 - c0 + 1), dtype=np.uint8)
+    event_matrix[0] = top_events
+    scores, events = top_scores, top_events
+    for i in range(r0 + 1, r1 + 1):
+        scores, events = fill_row(seq1, seq2, i, c0, c1, scores, events, left_scores[i - r0], left_events[i - r0], scoring)
+        event_matrix[i - r0] = events
+    path = []
+    i, j = r1, c1
+    while i > r0 and j > c0:
+        event = int(event_matrix[i - r0, j - c0])
+        path.append(event)
+        i -= event != INSERT
+        j -= event != DELETE
+    path.extend([DELETE] * (i - r0) + [INSERT] * (j - c0))
+    path.reverse()
+    return path, int(scores[-1])
+
+def linear_space_path(seq1, seq2, r0, r1, c0, c1, top_scores, top_events, left_scores, left_events, scoring):
+    # Divide and conquer traceback in O(m+n) memory: the path from the bottom right to the top left corner of
+    # the block is followed by propagating, below the middle row, the column where each cell's path enters it.
+    # Both halves are then solved the same way, so the path is exactly the one of the full matrix traceback
+    if (r1 - r0) * (c1 - c0) <= BLOCK_CELLS or r1 - r0 < 2:
+        return traceback_block(seq1, seq2, r0, r1, c0, c1, top_scores, top_events, left_scores, left_events, scoring)
+    mid = (r0 + r1) // 2
+    columns = np.arange(c0, c1 + 1)
+    scores, events = top_scores, top_events
+    for i in range(r0 + 1, r1 + 1):
+        scores, events = fill_row(seq1, seq2, i, c0, c1, scores, events, left_scores[i - r0], left_events[i - r0], scoring)
+        if i == mid:
+            mid_scores, mid_events = scores, events
+            cross = columns
+        elif i > mid:
+            # Matches and deletes take the column from the row above, inserts from the nearest cell on their left
+            step = np.empty_like(cross)
+            step[0] = c0
+            step[1:] = np.where(events[1:] == MATCH, cross[:-1], cross[1:])
+            source = np.where(events != INSERT, columns - c0, 0)
+            source[0] = 0
+            cross = step[np.maximum.accumulate(source)]
+    split, score = int(cross[-1]), int(scores[-1])
+
+    # Second pass over the lower left part for the column the lower half starts from
+    column_scores, column_events = [mid_scores[split - c0]], [mid_events[split - c0]]
+    scores, events = mid_scores[:split - c0 + 1], mid_events[:split - c0 + 1]
+    for i in range(mid + 1, r1 + 1):
+        scores, events = fill_row(seq1, seq2, i, c0, split, scores, events, left_scores[i - r0], left_events[i - r0], scoring)
+        column_scores.append(scores[-1])
+        column_events.append(events[-1])
+
+    upper, _ = linear_space_path(seq1, seq2, r0, mid, c0, split, top_scores[:split - c0 + 1], top_events[:split - c0 + 1], left_scores[:mid - r0 + 1], left_events[:mid - r0 + 1], scoring)
+    lower, _ = linear_space_path(seq1, seq2, mid, r1, split, c1, mid_scores[split - c0:], mid_events[split - c0:], np.array(column_scores, dtype=np.int32), np.array(column_events, dtype=np.uint8), scoring)
+    return upper + lower, score
+
+def band_limits(i, m, n, band):
+    # Columns of row i within band cells of the diagonals through both corners
+    if band is None:
+        return 0, n
+    return max(0, i + min(0, n - m) - band), min(n, i + max(0, n - m) + band)
+
+def row_values(row, lo, hi, start, stop):
+    # Values of a stored row for columns start to stop, unreachable outside its columns lo to hi
+    values = np.full(stop - start + 1, UNREACHABLE, dtype=np.int32)
+    a, b = max(start, lo), min(stop, hi)
+    if a <= b:
+        values[a - start:b - start + 1] = row[a - lo:b - lo + 1]
+    return values
+
+def gotoh_row(seq1, seq2, i, lo, hi, prev_lo, prev_hi, prev_best, prev_delete, scoring):
+    # One row of the three matrix recurrence: match, delete (gap in seq2) and insert (gap in seq1) scores,
+    # where a gap of length L costs affine_gap_penalty + (L-1) * gap_penalty
+    gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty, substitution = scoring
+    m, n = len(seq1), len(seq2)
+    start = max(lo, 1)
+    columns = np.arange(start, hi + 1)
+    match = row_values(prev_best, prev_lo, prev_hi, start - 1, hi - 1) + substitution[seq1[i - 1]][seq2[start - 1:hi]]
+    up_best = row_values(prev_best, prev_lo, prev_hi, start, hi)
+    up_delete = row_values(prev_delete, prev_lo, prev_hi, start, hi)
+    free_end = bool(unpenalized_start_end & FREE_END)
+    delete_open = np.where((columns == n) & free_end, 0, affine_gap_penalty).astype(np.int32)
+    delete_extend = np.where((columns == n) & free_end, 0, gap_penalty).astype(np.int32)
+    delete = np.maximum(up_best + delete_open, up_delete + delete_extend)
+    delete_extends = up_delete + delete_extend > up_best + delete_open
+
+    # Inserts run along the row: with t the column offset, the best open before column t is a running maximum
+    insert_open, insert_extend = (0, 0) if i == m and free_end else (affine_gap_penalty, gap_penalty)
+    left = boundary_score(i, scoring) if lo == 0 else UNREACHABLE
+    closed = np.concatenate(([left], np.maximum(match, delete))).astype(np.int32)
+    offsets = np.arange(len(closed), dtype=np.int32)
+    if insert_open <= insert_extend:
+        # Reopening never pays, so insert[t] = open + (t-1)*extend + max over s < t of closed[s] - s*extend
+        running = np.maximum.accumulate(closed - offsets * np.int32(insert_extend))
+        insert = running[:-1] + offsets[:-1] * np.int32(insert_extend) + np.int32(insert_open)
+    else:
+        # Reopening is cheaper than extending, so every insert opens from the best cell on its left
+        running = np.maximum.accumulate(closed - offsets * np.int32(insert_open)) + offsets * np.int32(insert_open)
+        insert = running[:-1] + np.int32(insert_open)
+    best = np.maximum(closed[1:], insert)
+    previous_best = np.concatenate(([left], best[:-1]))
+    previous_insert = np.concatenate(([UNREACHABLE], insert[:-1]))
+    insert_extends = previous_insert + np.int32(insert_extend) > previous_best + np.int32(insert_open)
+
+    trace = np.where((match >= delete) & (match >= insert), MATCH, np.where(delete >= insert, DELETE, INSERT)).astype(np.uint8)
+    trace |= (delete_extends * DELETE_EXTENDS | insert_extends * INSERT_EXTENDS).astype(np.uint8)
+    if lo == 0:
+        best = np.concatenate(([left], best))
+        delete = np.concatenate(([left], delete))
+        trace = np.concatenate(([DELETE], trace)).astype(np.uint8)
+    return best.astype(np.int32), delete.astype(np.int32), trace
+
+def gotoh(seq1, seq2, scoring, band=None, xdrop=None):
+    # Exact affine gap alignment (Gotoh) with a uint8 traceback cell per computed cell; with a band only the
+    # cells near the diagonal are computed and stored. Linear gaps give the same path as traceback_block.
+    # With xdrop every row only spans the columns of the row above scoring at most xdrop below its best;
+    # returns None if that window loses the bottom right corner. Besides the path and score, returns the widest
+    # band lying within the computed cells (-1 if there is none)
+    m, n = len(seq1), len(seq2)
+    limits, traces = [], []
+    lo, hi = band_limits(0, m, n, band)
+    best = np.array([boundary_score(j, scoring) for j in range(lo, hi + 1)], dtype=np.int32)
+    delete = np.full(hi - lo + 1, UNREACHABLE, dtype=np.int32)
+    limits.append((lo, hi))
+    traces.append(None)
     for i in range(1, m + 1):
-        for j in range(1, n + 1):
-            match = alignment_matrix[i - 1][j - 1] + (match_score if seq1[i - 1] == seq2[j - 1] else mismatch_penalty)
-            delete = alignment_matrix[i - 1][j] + (0 if j == n and unpenalized_start_end else gap_penalty if event_matrix[i-1][j] == "d" else affine_gap_penalty)
-            insert = alignment_matrix[i][j - 1] + (0 if i == m and unpenalized_start_end else gap_penalty if event_matrix[i][j-1] == "i" else affine_gap_penalty)
-            alignment_matrix[i][j] = max(match, delete, insert)
-            events = {'m': match, 'd': delete, 'i': insert}
-            event_matrix[i][j] = max(events, key=events.get)
-
-    # Traceback to find the aligned sequences
-    aligned_seq1, aligned_seq2, aligned_visual = [], [], []
+        prev_lo, prev_hi = lo, hi
+        if xdrop is None:
+            lo, hi = band_limits(i, m, n, band)
+        else:
+            kept = np.flatnonzero(best >= best.max() - xdrop)
+            lo, hi = prev_lo + kept[0], min(n, prev_lo + kept[-1] + 1)
+        row = gotoh_row(seq1, seq2, i, lo, hi, prev_lo, prev_hi, best, delete, scoring)
+        if xdrop is not None and hi < n:
+            # An insert run can stay within xdrop of the best of the row past the columns below the window
+            extra = insert_reach(int(row[0][-1]), int(row[0].max()) - xdrop, i, m, n, scoring)
+            if extra > 0:
+                hi = min(n, hi + extra)
+                row = gotoh_row(seq1, seq2, i, lo, hi, prev_lo, prev_hi, best, delete, scoring)
+        best, delete, trace = row
+        limits.append((lo, hi))
+        traces.append(trace)
+    if hi < n or best[-1] <= UNREACHABLE // 2:
+        return None
+
+    # Follow the matrices back: match moves diagonally, gaps stay in their matrix while they extend
+    path = []
     i, j = m, n
+    state = None
     while i > 0 and j > 0:
-        current_score = alignment_matrix[i][j]
-        if event_matrix[i][j] == 'm':
-            aligned_seq1.append(seq1[i - 1])
-            aligned_seq2.append(seq2[j - 1])
-            aligned_visual.append('|' if seq1[i - 1] == seq2[j - 1] else 'x')
-            i -= 1
-            j -= 1
-        elif event_matrix[i][j] == 'd':
-            aligned_seq1.append(seq1[i - 1])
+        cell = int(traces[i][j - limits[i][0]])
+        if state is None:
+            state = cell & 3
+        path.append(state)
+        if state == MATCH:
+            i, j, state = i - 1, j - 1, None
+        elif state == DELETE:
+            i, state = i - 1, DELETE if cell & DELETE_EXTENDS else None
+        else:
+            j, state = j - 1, INSERT if cell & INSERT_EXTENDS else None
+    path.extend([DELETE] * i + [INSERT] * j)
+    path.reverse()
+    return path, int(best[-1]), window_band(limits, m, n)
+
+def window_band(limits, m, n):
+    # Widest band (as in band_limits) whose cells are all within the columns lo to hi computed in every row
+    rows = np.arange(len(limits))
+    lo, hi = np.array(limits).T
+    band = np.minimum(np.where(lo > 0, rows + min(0, n - m) - lo, max(m, n)), np.where(hi < n, hi - rows - max(0, n - m), max(m, n)))
+    return max(-1, int(band.min()))
+
+def insert_reach(score, threshold, i, m, n, scoring):
+    # Number of inserts after a cell with this score that stay at or above the threshold
+    gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty, substitution = scoring
+    insert_open, insert_extend = (0, 0) if i == m and unpenalized_start_end & FREE_END else (affine_gap_penalty, gap_penalty)
+    if score + insert_open < threshold:
+        return 0
+    if insert_extend >= 0:
+        return n
+    return 1 + (score + insert_open - threshold) // -insert_extend
+
+def band_bound(m, n, band, scoring):
+    # Upper bound of any alignment leaving the band: it needs at least |n-m| + 2*(band+1) gap positions,
+    # and at best every other position is a match
+    gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty, substitution = scoring
+    gap_bound = 0 if unpenalized_start_end else max(gap_penalty, affine_gap_penalty)
+    if gap_bound > 0:
+        return None
+    gaps = abs(n - m) + 2 * (band + 1)
+    return max(int(substitution.max()), 0) * max(0, (m + n - gaps) // 2) + gap_bound * gaps
+
+def certified(score, covered, m, n, scoring):
+    # A score at least the bound of every alignment leaving a band computed in full is optimal
+    if covered >= max(m, n):
+        return True
+    bound = None if covered < 0 else band_bound(m, n, covered, scoring)
+    return bound is not None and score >= bound
+
+def adaptive_alignment(seq1, seq2, scoring, band=None, xdrop=None):
+    # Widen the band (or the x-drop) twofold until the result is certified against the widest band within the
+    # computed cells. An x-drop window losing the last cell, or scoring below the bound, is widened the same way;
+    # if the scoring has no bound the x-drop hands over to the full matrices
+    m, n = len(seq1), len(seq2)
+    if xdrop is not None:
+        if band_bound(m, n, 0, scoring) is None:
+            band = None
+        else:
+            while True:
+                result = gotoh(seq1, seq2, scoring, xdrop=xdrop)
+                if result is not None and certified(result[1], result[2], m, n, scoring):
+                    return result[:2]
+                xdrop = max(1, 2 * xdrop)
+    while True:
+        path, score, covered = gotoh(seq1, seq2, scoring, band)
+        if band is None or certified(score, covered, m, n, scoring):
+            return path, score
+        band = max(1, 2 * band)
+
+def seed_kmers(seq, k):
+    # Packed values and start positions of the kmers of a uint8 sequence
+    codes = SEED_CODES[seq]
+    if len(codes) < k:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.intp)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = np.flatnonzero(invalid[k:] - invalid[:-k] == 0)
+    codes = np.where(codes == 4, 0, codes).astype(np.uint64)
+    values = np.zeros(len(codes) - k + 1, dtype=np.uint64)
+    for offset in range(k):
+        values = (values << np.uint64(2)) | codes[offset:offset + len(values)]
+    return values[valid], valid
+
+def seed_anchors(seq1, seq2, k):
+    # Index the reference kmers (sorted values searched in bulk), look up every query kmer, and merge the hits
+    # following each other on a diagonal into exact match anchors (i, j, length)
+    reference_values, reference_positions = seed_kmers(seq2, k)
+    order = np.argsort(reference_values, kind='stable')
+    reference_values, reference_positions = reference_values[order], reference_positions[order]
+    query_values, query_positions = seed_kmers(seq1, k)
+    first = np.searchsorted(reference_values, query_values, side='left')
+    hits = np.searchsorted(reference_values, query_values, side='right') - first
+    keep = (hits > 0) & (hits <= SEED_MAX_HITS)
+    first, hits = first[keep], hits[keep]
+    seed_i = np.repeat(query_positions[keep], hits)
+    if len(seed_i) == 0:
+        # No kmer in common (or only repeats): no anchors, the whole pair is aligned as one block
+        return seed_i, seed_i.copy(), seed_i.copy()
+    seed_j = reference_positions[np.repeat(first - np.cumsum(hits) + hits, hits) + np.arange(hits.sum())]
+    diagonal = seed_j - seed_i
+    order = np.lexsort((seed_i, diagonal))
+    seed_i, diagonal = seed_i[order], diagonal[order]
+    starts = np.flatnonzero(np.concatenate(([True], (diagonal[1:] != diagonal[:-1]) | (seed_i[1:] != seed_i[:-1] + 1))))
+    lengths = np.diff(np.append(starts, len(seed_i))) + k - 1
+    return seed_i[starts], seed_i[starts] + diagonal[starts], lengths
+
+def chain_anchors(anchor_i, anchor_j, lengths):
+    # Heaviest chain of non overlapping anchors increasing in both sequences; moving between diagonals costs the shift
+    order = np.lexsort((anchor_j, anchor_i))
+    anchor_i, anchor_j, lengths = anchor_i[order], anchor_j[order], lengths[order]
+    diagonal = anchor_j - anchor_i
+    scores = lengths.astype(np.int64)
+    previous = np.full(len(lengths), -1)
+    for b in range(1, len(lengths)):
+        before = (anchor_i[:b] + lengths[:b] <= anchor_i[b]) & (anchor_j[:b] + lengths[:b] <= anchor_j[b])
+        candidates = np.where(before, scores[:b] - np.abs(diagonal[:b] - diagonal[b]), 0)
+        a = int(np.argmax(candidates))
+        if candidates[a] > 0:
+            scores[b] += candidates[a]
+            previous[b] = a
+    chain = []
+    b = int(np.argmax(scores)) if len(scores) > 0 else -1
+    while b >= 0:
+        chain.append((int(anchor_i[b]), int(anchor_j[b]), int(lengths[b])))
+        b = previous[b]
+    chain.reverse()
+    return chain
+
+def path_score(seq1, seq2, path, scoring):
+    # Score of a path under the same rules as the matrices: every gap run costs affine_gap_penalty + (L-1) * gap_penalty,
+    # except runs along the first row or column with an unpenalized start and the last with an unpenalized end; away from the first row and
+    # column a gap may also be reopened like in gotoh_row, so with a cheaper open every position costs the open
+    gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty, substitution = scoring
+    m, n = len(seq1), len(seq2)
+    path = np.array(path, dtype=np.uint8)
+    i = np.cumsum(path != INSERT) - (path != INSERT)
+    j = np.cumsum(path != DELETE) - (path != DELETE)
+    pairs = path == MATCH
+    score = int(substitution[seq1[i[pairs]], seq2[j[pairs]]].sum())
+    starts = np.flatnonzero(np.concatenate(([True], path[1:] != path[:-1]))) if len(path) > 0 else np.empty(0, dtype=np.intp)
+    lengths = np.diff(np.append(starts, len(path)))
+    for start, length in zip(starts.tolist(), lengths.tolist()):
+        event = path[start]
+        if event == MATCH:
+            continue
+        first = j[start] == 0 if event == DELETE else i[start] == 0
+        last = j[start] == n if event == DELETE else i[start] == m
+        if not (first and unpenalized_start_end & FREE_START or last and unpenalized_start_end & FREE_END):
+            score += affine_gap_penalty + (length - 1) * (gap_penalty if first else max(gap_penalty, affine_gap_penalty))
+    return int(score)
+
+def seed_alignment(seq1, seq2, scoring, k, linear_space=None, band=None, xdrop=None):
+    # Seed and extend: the chained anchors are kept as matches and only the blocks between them are aligned;
+    # gaps are only free at the outer ends of the whole alignment, so the first block keeps only its free start,
+    # the last block only its free end and the inner blocks are aligned with penalized ends
+    chain = chain_anchors(*seed_anchors(seq1, seq2, k))
+    unpenalized_start_end = scoring[3]
+    first_scoring = scoring[:3] + (unpenalized_start_end & FREE_START,) + scoring[4:]
+    inner_scoring = scoring[:3] + (0,) + scoring[4:]
+    last_scoring = scoring[:3] + (unpenalized_start_end & FREE_END,) + scoring[4:]
+    path = []
+    i0, j0 = 0, 0
+    for anchor, (i, j, length) in enumerate(chain):
+        path += align(seq1[i0:i], seq2[j0:j], first_scoring if anchor == 0 else inner_scoring, linear_space, band, xdrop)[0]
+        path += [MATCH] * length
+        i0, j0 = i + length, j + length
+    path += align(seq1[i0:], seq2[j0:], last_scoring if len(chain) > 0 else scoring, linear_space, band, xdrop)[0]
+    return path, path_score(seq1, seq2, path, scoring)
+
+def path_alignment(seq1, seq2, path, score):
+    # Gapped strings of a path as an Alignment, so plot_assemble.plot_alignment_coordinates can draw it
+    path = np.array(path, dtype=np.uint8)
+    aligned1 = np.full(len(path), ord('-'), dtype=np.uint8)
+    aligned2 = aligned1.copy()
+    aligned1[path != INSERT] = seq1
+    aligned2[path != DELETE] = seq2
+    return Alignment(aligned1.tobytes().decode(), aligned2.tobytes().decode(), score, 0, len(path))
+
+def pattern_masks(query):
+    # Bit i of the mask of a byte is set where query[i] is that byte; the whole query is one Python int
+    codes = np.frombuffer(query.encode(), dtype=np.uint8)
+    return {int(code): int.from_bytes(np.packbits(codes == code, bitorder='little').tobytes(), 'little') for code in np.unique(codes)}
+
+def myers_distance(masks, m, target):
+    # Bit-parallel edit distance (Myers, with Hyyro's global boundary): Pv and Mv hold the +1 and -1 vertical
+    # differences of the whole column, so each target base costs a few big integer operations instead of m cells
+    if m == 0:
+        return len(target)
+    full, last = (1 << m) - 1, 1 << (m - 1)
+    pv, mv, distance = full, 0, m
+    for code in target.encode():
+        eq = masks.get(code, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & last:
+            distance += 1
+        elif mh & last:
+            distance -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+    return distance
+
+def edit_distance(seq1, seq2):
+    # Unit cost edit distance of two strings and the identity 1 - distance / longer length
+    distance = myers_distance(pattern_masks(seq1), len(seq1), seq2)
+    return distance, 1 - distance / max(len(seq1), len(seq2), 1)
+
+def edit_distances(query, targets):
+    # One query against many targets: the query bit masks are built once
+    masks = pattern_masks(query)
+    results = []
+    for target in targets:
+        distance = myers_distance(masks, len(query), target)
+        results.append((distance, 1 - distance / max(len(query), len(target), 1)))
+    return results
+
+def read_substitution_matrix(matrix):
+    # Letters and scores of a substitution matrix file in the NCBI format (a header row of letters, then one row
+    # per letter), or of a matrix Biopython ships (BLOSUM62, PAM250, ...) when there is no such file
+    if os.path.isfile(matrix):
+        with open(matrix, 'r') as file:
+            rows = [line.split() for line in file if line.strip() and not line.startswith('#')]
+        letters = rows[0]
+        scores = {(row[0], b): float(value) for row in rows[1:] for b, value in zip(letters, row[1:])}
+    else:
+        from Bio.Align import substitution_matrices
+        loaded = substitution_matrices.load(matrix)
+        letters = list(loaded.alphabet)
+        scores = {(a, b): float(loaded[a][b]) for a in letters for b in letters}
+    if any(score != int(score) for score in scores.values()):
+        raise ValueError('Substitution matrix {} has non-integer scores'.format(matrix))
+    return letters, {pair: int(score) for pair, score in scores.items()}
+
+def substitution_table(letters, scores):
+    # 256x256 scores indexed by the byte codes of the two sequences, so a row of the matrices looks up all of its
+    # pairs at once; lower case letters score like upper case ones, bytes the matrix lacks like its unknown residue X
+    # (its minimum without one)
+    known = np.zeros(256, dtype=bool)
+    table = np.full((256, 256), min(scores.values()), dtype=np.int32)
+    for (a, b), score in scores.items():
+        for x in {a.upper(), a.lower()}:
+            for y in {b.upper(), b.lower()}:
+                table[ord(x), ord(y)] = score
+                known[ord(x)] = known[ord(y)] = True
+    if 'X' in letters:
+        codes = np.where(known, np.arange(256), ord('X'))
+        table = table[np.ix_(codes, codes)]
+    return table
+
+def make_scoring(gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty, substitution_matrix=None):
+    # Without a separate gap open penalty every gap position costs the gap penalty;
+    # without a substitution matrix identical bytes score the match score and all other pairs the mismatch penalty.
+    # Unpenalized start and end frees both sides, or only the FREE_START or FREE_END side it names
+    unpenalized_start_end = FREE_START | FREE_END if isinstance(unpenalized_start_end, (bool, np.bool_)) and unpenalized_start_end else int(unpenalized_start_end)
+    if affine_gap_penalty == 0:
+        affine_gap_penalty = gap_penalty
+    if substitution_matrix is None:
+        substitution = np.full((256, 256), mismatch_penalty, dtype=np.int32)
+        np.fill_diagonal(substitution, match_score)
+    else:
+        substitution = substitution_table(*read_substitution_matrix(substitution_matrix))
+    return (gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty, substitution)
+
+def align(seq1, seq2, scoring, linear_space=None, band=None, xdrop=None, seed=None):
+    # Path and score of the global alignment of two uint8 arrays with the engine the options ask for
+    gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty, substitution = scoring
+    m, n = len(seq1), len(seq2)
+    if seed is not None:
+        return seed_alignment(seq1, seq2, scoring, seed, linear_space, band, xdrop)
+    if band is not None or xdrop is not None or affine_gap_penalty != gap_penalty:
+        return adaptive_alignment(seq1, seq2, scoring, band, xdrop)
+
+    # Initialize the matrix with gap penalties
+    top_scores = np.array([boundary_score(j, scoring) for j in range(n + 1)], dtype=np.int32)
+    top_events = np.full(n + 1, INSERT, dtype=np.uint8)
+    top_events[0] = MATCH
+    left_scores = np.array([boundary_score(i, scoring) for i in range(m + 1)], dtype=np.int32)
+    left_events = np.full(m + 1, DELETE, dtype=np.uint8)
+    left_events[0] = MATCH
+
+    # Large pairs keep only a few rows at a time instead of the (m+1)x(n+1) matrices
+    if linear_space is None:
+        linear_space = (m + 1) * (n + 1) > LINEAR_SPACE_CELLS
+    if linear_space:
+        return linear_space_path(seq1, seq2, 0, m, 0, n, top_scores, top_events, left_scores, left_events, scoring)
+    return traceback_block(seq1, seq2, 0, m, 0, n, top_scores, top_events, left_scores, left_events, scoring)
+
+def path_summary(seq1, seq2, path):
+    # Identity (matching columns over alignment columns) and CIGAR string of a path, with seq2 as the reference:
+    # deletes consume only seq1 (I), inserts only seq2 (D)
+    path = np.array(path, dtype=np.uint8)
+    pairs = path == MATCH
+    matches = np.count_nonzero(seq1[np.cumsum(path != INSERT)[pairs] - 1] == seq2[np.cumsum(path != DELETE)[pairs] - 1])
+    starts = np.flatnonzero(np.concatenate(([True], path[1:] != path[:-1]))) if len(path) > 0 else np.empty(0, dtype=np.intp)
+    lengths = np.diff(np.append(starts, len(path)))
+    cigar = ''.join('{}{}'.format(length, "MID"[path[start]]) for start, length in zip(starts.tolist(), lengths.tolist()))
+    return matches / len(path) if len(path) > 0 else 0.0, cigar
+
+def read_fasta(fasta_file):
+    # (name, sequence) of every record; the name is the first word of the header, the sequence may span several lines
+    records, name, parts = [], None, []
+    with open(fasta_file, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    records.append((name, ''.join(parts)))
+                name, parts = (line[1:].split() or [''])[0], []
+            elif line:
+                parts.append(line)
+    if name is not None:
+        records.append((name, ''.join(parts)))
+    return records
+
+# Sequences and options of the batch, set up once in every worker
+batch_setup = {}
+
+def init_batch(queries, references, scoring, linear_space, band, xdrop, seed):
+    batch_setup['queries'] = [np.frombuffer(sequence.encode(), dtype=np.uint8) for sequence in queries]
+    batch_setup['references'] = [np.frombuffer(sequence.encode(), dtype=np.uint8) for sequence in references]
+    batch_setup['options'] = (scoring, linear_space, band, xdrop, seed)
+
+def align_batch_pair(pair):
+    query, reference = pair
+    seq1, seq2 = batch_setup['queries'][query], batch_setup['references'][reference]
+    path, score = align(seq1, seq2, *batch_setup['options'])
+    identity, cigar = path_summary(seq1, seq2, path)
+    return query, reference, score, identity, cigar
+
+def align_batch(queries, references, pairs, scoring, workers=1, linear_space=None, band=None, xdrop=None, seed=None):
+    # Align the (query, reference) index pairs, yielding (query, reference, score, identity, cigar) as they finish;
+    # the sequences are sent to every worker once instead of with every pair
+    setup = (queries, references, scoring, linear_space, band, xdrop, seed)
+    if workers <= 1:
+        init_batch(*setup)
+        for pair in pairs:
+            yield align_batch_pair(pair)
+        return
+    with Pool(workers, initializer=init_batch, initargs=setup) as pool:
+        for result in pool.imap_unordered(align_batch_pair, pairs, chunksize=4):
+            yield result
+
+def init_edit_batch(queries, references):
+    batch_setup['query_sequences'] = queries
+    batch_setup['reference_sequences'] = references
+
+def edit_distance_batch_query(task):
+    # Results of one query as (query, reference, distance, identity) rows
+    query, references = task
+    targets = [batch_setup['reference_sequences'][reference] for reference in references]
+    distances = edit_distances(batch_setup['query_sequences'][query], targets)
+    return [(query, reference, distance, identity) for reference, (distance, identity) in zip(references, distances)]
+
+def edit_distance_batch(queries, references, pairs, workers=1):
+    # Edit distance and identity of the (query, reference) index pairs, one task per query so its bit masks
+    # are built once; yields (query, reference, distance, identity)
+    grouped = {}
+    for query, reference in pairs:
+        grouped.setdefault(query, []).append(reference)
+    tasks = list(grouped.items())
+    if workers <= 1:
+        init_edit_batch(queries, references)
+        for task in tasks:
+            yield from edit_distance_batch_query(task)
+        return
+    with Pool(workers, initializer=init_edit_batch, initargs=(queries, references)) as pool:
+        for rows in pool.imap_unordered(edit_distance_batch_query, tasks):
+            yield from rows
+
+def batch_main(args, scoring):
+    # Many against many: every query record against every reference record, or the name pairs of --pairs
+    queries, references = read_fasta(args.query), read_fasta(args.reference)
+    if args.pairs is None:
+        pairs = [(query, reference) for query in range(len(queries)) for reference in range(len(references))]
+    else:
+        query_index = {name: index for index, (name, _) in enumerate(queries)}
+        reference_index = {name: index for index, (name, _) in enumerate(references)}
+        with open(args.pairs, 'r') as file:
+            names = [line.split()[:2] for line in file if line.strip()]
+        unknown = ({query for query, _ in names} - query_index.keys()) | ({reference for _, reference in names} - reference_index.keys())
+        if unknown:
+            raise SystemExit("Unknown sequence names in {}: {}".format(args.pairs, ', '.join(sorted(unknown))))
+        pairs = [(query_index[query], reference_index[reference]) for query, reference in names]
+    # Long pairs first, so the pool does not end waiting on one of them
+    pairs.sort(key=lambda pair: len(queries[pair[0]][1]) * len(references[pair[1]][1]), reverse=True)
+    if args.edit_distance:
+        with open(args.output, 'w') as file:
+            file.write("query\treference\tdistance\tidentity\n")
+            for query, reference, distance, identity in edit_distance_batch([sequence for _, sequence in queries], [sequence for _, sequence in references], pairs, args.workers):
+                file.write("{}\t{}\t{}\t{:.4f}\n".format(queries[query][0], references[reference][0], distance, identity))
+                file.flush()
+        return
+    with open(args.output, 'w') as file:
+        file.write("query\treference\tscore\tidentity\tcigar\n")
+        for query, reference, score, identity, cigar in align_batch([sequence for _, sequence in queries], [sequence for _, sequence in references], pairs, scoring, args.workers, args.linear_space, args.band, args.xdrop, args.seed):
+            file.write("{}\t{}\t{}\t{:.4f}\t{}\n".format(queries[query][0], references[reference][0], score, identity, cigar))
+            file.flush()
+
+def read_sequence(sequence_file):
+    # Annotation line and sequence line of a two line sequence file
+    with open('{}'.format(sequence_file), 'r') as file:
+        lines = file.readlines()
+        file.close()
+    return lines[0].replace("\n",''), lines[1].replace("\n",'')
+
+def needleman_wunsch(seq1_file, seq2_file, output, gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty, linear_space=None, band=None, xdrop=None, seed=None, substitution_matrix=None):
+    # Initialize the alignment matrix
+    anno1, seq1 = read_sequence(seq1_file)
+    anno2, seq2 = read_sequence(seq2_file)
+    scoring = make_scoring(gap_penalty, mismatch_penalty, match_score, unpenalized_start_end, affine_gap_penalty, substitution_matrix)
+    codes1, codes2 = np.frombuffer(seq1.encode(), dtype=np.uint8), np.frombuffer(seq2.encode(), dtype=np.uint8)
+    path, score = align(codes1, codes2, scoring, linear_space, band, xdrop, seed)
+
+    # Build the aligned sequences along the path
+    aligned_seq1, aligned_seq2, aligned_visual = [], [], []
+    i, j = 0, 0
+    for event in path:
+        if event == MATCH:
+            aligned_seq1.append(seq1[i])
+            aligned_seq2.append(seq2[j])
+            aligned_visual.append('|' if seq1[i] == seq2[j] else 'x')
+            i += 1
+            j += 1
+        elif event == DELETE:
+            aligned_seq1.append(seq1[i])
             aligned_seq2.append('_')
             aligned_visual.append(' ')
-            i -= 1
+            i += 1
         else:
             aligned_seq1.append('_')
-            aligned_seq2.append(seq2[j - 1])
+            aligned_seq2.append(seq2[j])
             aligned_visual.append(' ')
-            j -= 1
-
-    # Finish tracing back if there are remaining elements
-    while i > 0:
-        aligned_seq1.append(seq1[i - 1])
-        aligned_seq2.append('_')
-        aligned_visual.append(' ')
-        i -= 1
-    while j > 0:
-        aligned_seq1.append('_')
-        aligned_seq2.append(seq2[j - 1])
-        aligned_visual.append(' ')
-        j -= 1
-
-    # Reverse the aligned sequences
-    aligned_seq1.reverse()
-    aligned_seq2.reverse()
-    aligned_visual.reverse()
-
-    return ''.join(anno1), ''.join(anno2), ''.join(aligned_seq1), ''.join(aligned_seq2), ''.join(aligned_visual), alignment_matrix[m][n], ''.join(output)
+            j += 1
+
+    return ''.join(anno1), ''.join(anno2), ''.join(aligned_seq1), ''.join(aligned_seq2), ''.join(aligned_visual), score, ''.join(output)
 
 def main():
     parser = argparse.ArgumentParser(description='Needleman-Wunsch Global Sequence Alignment')
@@ -87,10 +646,33 @@ def main():
     parser.add_argument('-p', '--mismatch_penalty', type=int, default=-1, help='Mismatch penalty (default: -1)')
     parser.add_argument('-m', '--match_score', type=int, default=1, help='Match score (default: 1)')
     parser.add_argument('--ignore_outer_gaps', action='store_true', help='Unpenalized start and end for both sequences')
-    parser.add_argument('-s', '--affine_gap_penalty', required=False, default=0, type=int)
+    parser.add_argument('-s', '--affine_gap_penalty', required=False, default=0, type=int, help='Gap open penalty, the first position of a gap costs this instead of the gap penalty (default: the gap penalty)')
+    parser.add_argument('--matrix', type=str, default=None, help='Substitution matrix scoring aligned pairs instead of the match score and mismatch penalty: a matrix Biopython ships (BLOSUM62, PAM250, ...) or a file in the NCBI format')
+    parser.add_argument('--linear_space', action='store_true', default=None, help='Always use the O(m+n) memory divide and conquer traceback for linear gaps (default: only above {} cells)'.format(LINEAR_SPACE_CELLS))
+    parser.add_argument('--band', type=int, default=None, help='Only compute cells within this many diagonals of the main diagonals, doubling the band until no alignment leaving it can score higher; affine gaps always use the one byte per cell Gotoh traceback, so large affine alignments should set it')
+    parser.add_argument('--xdrop', type=int, default=None, help='Only compute the cells of each row reachable from cells scoring at most this much below the best of the row above, doubling it until the end is reached and no alignment leaving the computed cells can score higher')
+    parser.add_argument('--seed', type=int, default=None, help='Seed and extend: chain the exact matches of reference kmers of this length (up to 32) and only align the blocks between them')
+    parser.add_argument('--edit_distance', action='store_true', help='Only compute the unit cost edit distance and identity with the bit-parallel engine, no alignment')
+    parser.add_argument('--batch', action='store_true', help='Query and reference are multi-record FASTA files; write score, identity and CIGAR of every pair to the output as a table')
+    parser.add_argument('--pairs', type=str, default=None, help='With --batch, only align the query and reference names listed on each line of this file')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='With --batch, number of processes aligning pairs in parallel (default: all cores)')
     args = parser.parse_args()
-    
-    annotation1, annotation2, aligned_seq1, aligned_seq2, visualization, aligned_score, output_file = needleman_wunsch(args.query, args.reference, args.output, args.gap_penalty, args.mismatch_penalty, args.match_score, args.ignore_outer_gaps, args.affine_gap_penalty)
+    if args.seed is not None and not 1 <= args.seed <= 32:
+        # Seeds are packed 2 bits per base in 64 bits
+        parser.error('--seed must be between 1 and 32')
+
+    if args.batch:
+        batch_main(args, make_scoring(args.gap_penalty, args.mismatch_penalty, args.match_score, args.ignore_outer_gaps, args.affine_gap_penalty, args.matrix))
+        return
+    if args.edit_distance:
+        annotation1, seq1 = read_sequence(args.query)
+        annotation2, seq2 = read_sequence(args.reference)
+        distance, identity = edit_distance(seq1, seq2)
+        with open('{}'.format(args.output), 'w') as file:
+            file.writelines(["{}\n".format(distance), "{:.4f}\n".format(identity), "{}\n".format(annotation1), "{}\n".format(annotation2)])
+            file.close()
+        return
+    annotation1, annotation2, aligned_seq1, aligned_seq2, visualization, aligned_score, output_file = needleman_wunsch(args.query, args.reference, args.output, args.gap_penalty, args.mismatch_penalty, args.match_score, args.ignore_outer_gaps, args.affine_gap_penalty, args.linear_space, args.band, args.xdrop, args.seed, args.matrix)
 
     lines_to_write = ["{}\n".format(aligned_score), "{}\n".format(annotation1), "{}\n".format(aligned_seq1), "{}\n".format(visualization), "{}\n".format(aligned_seq2), "{}\n".format(annotation2)]
     with open('{}'.format(output_file), 'w') as file:
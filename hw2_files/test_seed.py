@@ -0,0 +1,39 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from aligner import align, make_scoring, read_sequence
+
+def mutate(sequence, positions):
+    # Copy of a uint8 sequence with the bases at the positions replaced by the next base
+    sequence = sequence.copy()
+    for position in positions:
+        sequence[position] = b'CGTA'[b'ACGT'.index(bytes(sequence[position:position + 1]))]
+    return sequence
+
+# Seed and extend has to find the full alignment score on near identical sequences: sub-reads of the spike with
+# unpenalized outer gaps, as a contig against its reference, and mutated copies of the whole spike with penalized ones.
+# The sub-reads get a substitution within their first and last few bases, where a free gap at the inner end of the
+# outer blocks used to pull the read ends away from the anchors
+def test_seed_matches_full_alignment(cases=12, seed=12):
+    annotation, reference = read_sequence(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sars_spike_protein.fna'))
+    reference = np.frombuffer(reference.encode(), dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    for case in range(cases):
+        length = int(rng.integers(200, 2000))
+        start = int(rng.integers(0, len(reference) - length))
+        ends = [int(rng.integers(0, 4)), length - 1 - int(rng.integers(0, 4))]
+        sub_read = mutate(reference[start:start + length], ends + rng.integers(0, length, size=int(rng.integers(0, 6))).tolist())
+        copy = mutate(reference, rng.integers(0, len(reference), size=int(rng.integers(0, 20))).tolist())
+        pairs = [(sub_read, True, 'sub-read {}:{}'.format(start, start + length)), (copy, False, 'mutated copy {}'.format(case))]
+        for query, unpenalized_start_end, name in pairs:
+            for affine_gap_penalty in (0, -5):
+                scoring = make_scoring(-2, -1, 1, unpenalized_start_end, affine_gap_penalty)
+                full = align(query, reference, scoring)[1]
+                seeded = align(query, reference, scoring, seed=seed)[1]
+                assert seeded == full, "{} gap open {}: seed {} full {}".format(name, affine_gap_penalty, seeded, full)
+
+if __name__ == "__main__":
+    test_seed_matches_full_alignment()
+    print("Seed and full alignment scores agree")
@@ -1,5 +1,15 @@
-import sys
+import argparse
+import os
 import numpy as np
+from multiprocessing import Pool
+
+Q_BLOCK_ROWS = 256
+# Rapid search: entries first read of every sorted row, and the relative slack of its bounds, far above the
+# rounding drift of the running row sums
+RAPID_WINDOW = 16
+RAPID_SLACK = 1e-9
+# Largest table of per-column mismatches of every pair the bootstrap keeps
+BOOTSTRAP_TABLE_CELLS = 1 << 25
 
 def calculate_genetic_distance(seq1, seq2):
     length = min(len(seq1), len(seq2))
@@ -7,71 +17,251 @@ def calculate_genetic_distance(seq1, seq2):
     distance = (mismatches / length)
     return distance
 
-def write_genetic_distances(sequences, output_file):
+def encode_sequences(sequences):
+    # One uint8 row per sequence and the sequence lengths; shorter sequences are padded with zeros
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    codes = np.zeros((len(sequences), lengths.max(initial=0)), dtype=np.uint8)
+    for i, seq in enumerate(sequences):
+        codes[i, :lengths[i]] = np.frombuffer(seq.encode(), dtype=np.uint8)
+    return codes, lengths
+
+def distance_matrix(codes, lengths):
+    # Same distances as calculate_genetic_distance for every pair: each row is compared with all rows below it at once,
+    # and the upper triangle is mirrored
+    n = len(codes)
+    ragged = len(set(lengths.tolist())) > 1
+    mismatches = np.zeros((n, n), dtype=np.int64)
+    for i in range(n - 1):
+        others = codes[i + 1:, :lengths[i]]
+        differ = others != codes[i, :lengths[i]]
+        if ragged:
+            # Only the columns both sequences have count
+            differ &= others != 0
+        mismatches[i, i + 1:] = np.count_nonzero(differ, axis=1)
+    mismatches += mismatches.T
+    return mismatches / np.minimum.outer(lengths, lengths)
+
+def write_distance_matrix(matrix, names, output_file):
+    # A .npy file keeps the array as is, anything else gets the tab separated text table
+    if output_file.endswith('.npy'):
+        np.save(output_file, matrix)
+        return
     with open(output_file, 'w') as f:
         # Write header
-        f.write('\t'.join(sequences.keys()) + '\n')
+        f.write('\t'.join(names) + '\n')
         # Write rows
-        for seq_id1, seq1 in sequences.items():
+        for seq_id1, distance in zip(names, matrix.tolist()):
             f.write(seq_id1 + '\t')
-            distance = []
-            for seq_id2, seq2 in sequences.items():
-                distance.append(calculate_genetic_distance(seq1, seq2))
             line = '\t'.join(map(str, distance)) + '\n'
             f.write(line)
 
-def neighbor_joining(matrix, names):
+def write_genetic_distances(sequences, output_file):
+    matrix = distance_matrix(*encode_sequences(list(sequences.values())))
+    write_distance_matrix(matrix, list(sequences.keys()), output_file)
+
+def exact_sums(matrix, ids, m, rows):
+    # Sums of the given rows over the first m slots, adding the columns in node number order: the order of the
+    # reference's shrinking matrix, so near ties of the Q-matrix (always there when four clusters are left) are
+    # broken the same way
+    return np.take(matrix[rows], np.argsort(ids[:m]), axis=1).sum(axis=1)
+
+def min_q_pair(matrix, sums, ids, m):
+    # Slots of the smallest Q-matrix entry among the first m slots, in row blocks to keep the temporaries small.
+    # Like the reference scan, an entry is only evaluated with the smaller node number as the row, the same
+    # floating point expression, and ties go to the pair with the smallest node numbers
+    best, rows, cols = np.inf, [], []
+    for start in range(0, m, Q_BLOCK_ROWS):
+        stop = min(m, start + Q_BLOCK_ROWS)
+        q_block = (m - 2) * matrix[start:stop, :m] - sums[start:stop, np.newaxis] - sums[np.newaxis, :m]
+        q_block[ids[start:stop, np.newaxis] >= ids[np.newaxis, :m]] = np.inf
+        block_min = q_block.min()
+        if block_min < best:
+            best, rows, cols = block_min, [], []
+        if block_min == best:
+            r, c = np.nonzero(q_block == block_min)
+            rows.append(r + start)
+            cols.append(c)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    k = np.lexsort((ids[cols], ids[rows]))[0]
+    return rows[k], cols[k]
+
+def rapid_q_pair(matrix, ids, m, sums, sorted_distances, sorted_nodes, lengths, starts, slot_of_node):
+    # RapidNJ search: every slot keeps the distances to the clusters that existed when it was made in increasing order,
+    # so a row is only read while (m-2)*d - sums[row] - max(sums) can still beat the best Q entry seen. Rows are read
+    # in windows, all rows at once, doubling the window for the rows that still need more. The running sums drift
+    # by rounding, so every entry within a small slack of the best is evaluated again like min_q_pair
+    sum_max = sums[:m].max()
+    best, found = np.inf, []
+    pending, reached, width = np.arange(m), starts[:m].copy(), RAPID_WINDOW
+    while len(pending) > 0:
+        cols = reached[pending, np.newaxis] + np.arange(width)
+        inside = cols < lengths[pending, np.newaxis]
+        cols = np.minimum(cols, lengths[pending, np.newaxis] - 1)
+        others = slot_of_node[sorted_nodes[pending[:, np.newaxis], cols]]
+        if width == RAPID_WINDOW:
+            # Entries of joined clusters at the front of a row are skipped for good
+            dead = (others < 0) & inside
+            starts[pending] += np.where(dead.all(axis=1), width, np.argmin(dead, axis=1))
+        inside &= others >= 0
+        q = (m - 2) * sorted_distances[pending[:, np.newaxis], cols] - sums[pending, np.newaxis] - sums[np.maximum(others, 0)]
+        q[~inside] = np.inf
+        best = min(best, q.min())
+        r, c = np.nonzero(inside)
+        found.append((pending[r], others[r, c], q[r, c]))
+        # Rows whose next entry is still below the bound are read further
+        slack = RAPID_SLACK * (abs(best) + 2 * abs(sum_max) + 1)
+        bound = (best + slack + sums[pending] + sum_max) / (m - 2)
+        reached[pending] += width
+        more = reached[pending] < lengths[pending]
+        more[more] = sorted_distances[pending[more], reached[pending[more]]] <= bound[more]
+        pending, width = pending[more], width * 2
+
+    rows, cols, q = (np.concatenate(values) for values in zip(*found))
+    slack = RAPID_SLACK * (abs(best) + 2 * abs(sum_max) + 1)
+    near = q <= best + slack
+    rows, cols = rows[near], cols[near]
+    rows, cols = np.where(ids[rows] < ids[cols], rows, cols), np.where(ids[rows] < ids[cols], cols, rows)
+    candidates = np.unique(np.concatenate((rows, cols)))
+    exact = np.zeros(m)
+    exact[candidates] = exact_sums(matrix, ids, m, candidates)
+    q = (m - 2) * matrix[rows, cols] - exact[rows] - exact[cols]
+    k = np.lexsort((ids[cols], ids[rows], q))[0]
+    return rows[k], cols[k]
+
+def neighbor_joining(matrix, names, rapid=False):
+    # Tree rows (ancestor, descendant, branch length) numbered like the R plotting script expects, and for every row
+    # the leaves under its descendant as packed bits. The m active clusters always fill the first m slots of one
+    # preallocated matrix: a join writes the new cluster over one of its children and moves the last slot into the other.
+    # The rapid search gives the same tree, it just evaluates far fewer Q-matrix entries
     n = len(matrix)
     tree = np.zeros((2 * n - 3, 3))  # Initialize the tree matrix
-    par = np.array(['str' for i in range(2*n -3)], dtype=object)
-    # Function to find the minimum element in the distance matrix
-    nodes = [i for i in range(1,len(names)+1)] # Initialize the nodes number
-    def find_min_element(dist_matrix):
-        min_val = float('inf')
-        min_i, min_j = -1, -1
-        for i in range(len(dist_matrix)):
-            for j in range(i + 1, len(dist_matrix)):
-                if dist_matrix[i, j] < min_val:
-                    min_val = dist_matrix[i, j]
-                    min_i, min_j = i, j
-        return min_i, min_j
-    # Main Neighbor-Joining algorithm
+    par = np.zeros((2 * n - 3, (n + 7) // 8), dtype=np.uint8)
+    matrix = np.array(matrix, dtype=float)
+    ids = np.arange(1, n + 1)  # Node number of every slot
+    slot_of_leaf = np.arange(n)
+    if rapid:
+        sums = matrix.sum(axis=1)
+        # Sorted rows without the cluster itself, which sorts first with its distance set to -inf
+        order = np.argsort(np.where(np.eye(n, dtype=bool), -np.inf, matrix), axis=1, kind='stable')[:, 1:]
+        sorted_distances = np.zeros((n, n))
+        sorted_nodes = np.zeros((n, n), dtype=np.int64)
+        sorted_distances[:, :n - 1] = np.take_along_axis(matrix, order, axis=1)
+        sorted_nodes[:, :n - 1] = order + 1
+        lengths = np.full(n, n - 1)
+        starts = np.zeros(n, dtype=np.int64)
+        slot_of_node = np.full(2 * n, -1)
+        slot_of_node[1:n + 1] = np.arange(n)
     for step in range(n - 2):
-        total_dist = np.sum(matrix, axis=1)
-        q_matrix = (n - 2 - step) * matrix - total_dist[:, np.newaxis] - total_dist[np.newaxis, :]
-        # Find the minimum element in the Q-matrix
-        i, j = find_min_element(q_matrix)
+        m = n - step
+        # Find the minimum element in the Q-matrix, i is the child with the smaller node number
+        if rapid:
+            i, j = rapid_q_pair(matrix, ids, m, sums, sorted_distances, sorted_nodes, lengths, starts, slot_of_node)
+            sum_i, sum_j = exact_sums(matrix, ids, m, [i, j])
+        else:
+            exact = exact_sums(matrix, ids, m, slice(0, m))
+            i, j = min_q_pair(matrix, exact, ids, m)
+            sum_i, sum_j = exact[i], exact[j]
         # Calculate the new node and update the tree matrix
-        new_node = n + step
-        limb_i = 0.5 * (matrix[i, j] + ((total_dist[i] - total_dist[j]) / (n - 2 - step)))
+        new_node = n + step + 1
+        limb_i = 0.5 * (matrix[i, j] + ((sum_i - sum_j) / (m - 2)))
         limb_j = matrix[i, j] - limb_i
+        tree[2*step] = new_node, ids[i], limb_i
+        tree[2*step+1] = new_node, ids[j], limb_j
+        par[2*step] = np.packbits(slot_of_leaf == i)
+        par[2*step+1] = np.packbits(slot_of_leaf == j)
         # Update the distance matrix for the new node
-        new_distances = 0.5 * (matrix[i, :] + matrix[j, :] - matrix[i, j])
-        matrix = np.column_stack([matrix, new_distances.reshape(-1, 1)])
-        matrix = np.vstack([matrix, np.append(new_distances,0)])
-        matrix = np.delete(matrix, j, axis=0)
-        matrix = np.delete(matrix, i, axis=0)
-        matrix = np.delete(matrix, j, axis=1)
-        matrix = np.delete(matrix, i, axis=1)
-        nodes.append(new_node+1)
-        tree[2*step, 0] = nodes[-1]
-        tree[2*step, 1] = nodes[i]
-        tree[2*step, 2] = limb_i
-        par[2*step] = str(nodes[i]) if nodes[i] <= n else ' '.join(np.char.mod('%s', par[tree[:, 0] == nodes[i]]))
-        tree[2*step+1, 0] = nodes[-1]
-        tree[2*step+1, 1] = nodes[j]
-        tree[2*step+1, 2] = limb_j
-        par[2*step+1] = str(nodes[j]) if nodes[j] <= n else ' '.join(np.char.mod('%s', par[tree[:, 0] == nodes[j]]))
-        del nodes[j]
-        del nodes[i]
-        names.append(f"Internal_{new_node + 1}")
+        new_distances = 0.5 * (matrix[i, :m] + matrix[j, :m] - matrix[i, j])
+        low, high, last = min(i, j), max(i, j), m - 1
+        if rapid:
+            sums[:m] += new_distances - matrix[:m, i] - matrix[:m, j]
+            sums[low] = new_distances.sum()
+            others = np.flatnonzero((np.arange(m) != i) & (np.arange(m) != j))
+            order = others[np.argsort(new_distances[others], kind='stable')]
+            sorted_distances[low, :m - 2] = new_distances[order]
+            sorted_nodes[low, :m - 2] = ids[order]
+            lengths[low], starts[low] = m - 2, 0
+            slot_of_node[[ids[i], ids[j]]] = -1
+            slot_of_node[new_node] = low
+        matrix[low, :m] = matrix[:m, low] = new_distances
+        matrix[low, low] = 0
+        ids[low] = new_node
+        slot_of_leaf[(slot_of_leaf == i) | (slot_of_leaf == j)] = low
+        if high != last:
+            matrix[high, :m] = matrix[:m, high] = matrix[last, :m]
+            matrix[high, high] = 0
+            ids[high] = ids[last]
+            slot_of_leaf[slot_of_leaf == last] = high
+            if rapid:
+                sums[high] = sums[last]
+                sorted_distances[high], sorted_nodes[high] = sorted_distances[last], sorted_nodes[last]
+                lengths[high], starts[high] = lengths[last], starts[last]
+                slot_of_node[ids[high]] = high
+        names.append(f"Internal_{new_node}")
     # Add the final node
-    tree[-1, 0] = nodes[1]
-    tree[-1, 1] = nodes[0]
-    tree[-1, 2] = 0.5 * matrix[0,1]
-    par[-1] = str(nodes[0]) if nodes[0] <= n else ' '.join(np.char.mod('%s', par[tree[:, 0] == nodes[0]]))
+    first, second = (0, 1) if ids[0] < ids[1] else (1, 0)
+    tree[-1] = ids[second], ids[first], 0.5 * matrix[0, 1]
+    par[-1] = np.packbits(slot_of_leaf == first)
     return tree,par
 
+def weighted_distances(patterns, weights, length, pair_table=None):
+    # Distances of an alignment given as its distinct columns and the number of times each is used:
+    # the mismatches of every pair add up the per-column mismatches times the column counts. With the table of those
+    # per-column mismatches for every pair above the diagonal this is one matrix-vector product; its float32 sums of
+    # whole numbers stay exact below 2**24 columns
+    n = len(patterns)
+    mismatches = np.zeros((n, n))
+    if pair_table is not None:
+        mismatches[np.triu_indices(n, 1)] = pair_table @ weights.astype(np.float32)
+    else:
+        for i in range(n - 1):
+            mismatches[i, i + 1:] = (patterns[i + 1:] != patterns[i]) @ weights
+    mismatches += mismatches.T
+    return mismatches / length
+
+def tree_joins(par):
+    # Every join of a tree as the set of the leaf sets of its two children
+    return [frozenset((par[2*k].tobytes(), par[2*k + 1].tobytes())) for k in range(len(par) // 2)]
+
+# Alignment and tree of the bootstrap, set up once in every worker
+bootstrap_setup = {}
+
+def init_bootstrap(patterns, column_pattern, joins, rapid):
+    pair_table = None
+    if len(patterns) * (len(patterns) - 1) // 2 * patterns.shape[1] <= BOOTSTRAP_TABLE_CELLS and len(column_pattern) < 1 << 24:
+        rows, cols = np.triu_indices(len(patterns), 1)
+        pair_table = (patterns[rows] != patterns[cols]).astype(np.float32)
+    bootstrap_setup['alignment'] = (patterns, column_pattern, pair_table)
+    bootstrap_setup['joins'] = joins
+    bootstrap_setup['rapid'] = rapid
+
+def bootstrap_replicate(seed):
+    # Which joins of the tree one replicate reproduces; all of its columns are drawn in one call
+    patterns, column_pattern, pair_table = bootstrap_setup['alignment']
+    rng = np.random.default_rng(seed)
+    length = len(column_pattern)
+    weights = np.bincount(column_pattern[rng.integers(0, length, length)], minlength=patterns.shape[1])
+    tree_bs,par_bs = neighbor_joining(weighted_distances(patterns, weights, length, pair_table), [], bootstrap_setup['rapid'])
+    # A join is supported when the replicate joins the same two leaf sets
+    joins_bs = set(tree_joins(par_bs))
+    return np.array([join in joins_bs for join in bootstrap_setup['joins']])
+
+def bootstrap(codes, par, replicates, workers=1, seed=None, rapid=False):
+    # Fraction of the replicates reproducing every join of the tree. Each replicate gets its own seed spawned from the
+    # given one, so the result does not depend on the number of workers or the order replicates finish in
+    patterns, column_pattern = np.unique(codes, axis=1, return_inverse=True)
+    setup = (patterns, column_pattern.reshape(-1), tree_joins(par), rapid)
+    seeds = np.random.SeedSequence(seed).spawn(replicates)
+    support = np.zeros(len(par) // 2, dtype=np.int64)
+    if workers <= 1:
+        init_bootstrap(*setup)
+        for replicate_seed in seeds:
+            support += bootstrap_replicate(replicate_seed)
+    else:
+        with Pool(workers, initializer=init_bootstrap, initargs=setup) as pool:
+            for supported in pool.imap_unordered(bootstrap_replicate, seeds, chunksize=max(1, replicates // (4 * workers))):
+                support += supported
+    return support / max(replicates, 1)
+
 def write_tree_to_file(tree, output_file):
     with open(output_file, "w") as file:
         for row in tree:
@@ -80,78 +270,40 @@ def write_tree_to_file(tree, output_file):
         file.close()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 1:
-        print("Usage: python3 neighbor_joining.py hw3.fna")
-        sys.exit(1)
-    fasta_file = sys.argv[1]
-    output_file = "genetic-distances.txt"
+    parser = argparse.ArgumentParser(description='Neighbor-joining tree with bootstrap support')
+    parser.add_argument('fasta_file', type=str, help='Aligned sequences, one header line and one sequence line each (e.g. hw3.fna)')
+    parser.add_argument('--rapid', action='store_true', help='Find the pair to join with the RapidNJ bounds on sorted rows instead of the whole Q-matrix, the tree is the same')
+    parser.add_argument('--replicates', type=int, default=100, help='Number of bootstrap replicates (default: 100)')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the bootstrap replicates, for reproducible support values (default: a fresh one)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of processes computing bootstrap replicates in parallel (default: all cores)')
+    parser.add_argument('-d', '--distances', type=str, default=None, help='Also write the distance matrix to this file: tab separated text like genetic-distances.txt, or a NumPy array if it ends in .npy')
+    args = parser.parse_args()
     # Read sequences from FASTA file
     sequences = {}
-    with open('{}'.format(fasta_file), 'r') as file:
+    with open('{}'.format(args.fasta_file), 'r') as file:
         lines = file.readlines()
         anno = lines[0::2]
         seq = lines[1::2]
         for i in range(len(anno)):
             sequences[anno[i].replace("\n",'').replace(">",'')] = str(seq[i].replace("\n",''))
         file.close()
+    names = list(sequences.keys())
+    codes, lengths = encode_sequences(list(sequences.values()))
 
-    # Calculate and write genetic distances
-    write_genetic_distances(sequences, output_file)
-    ary = []
-    with open('{}'.format(output_file), 'r') as file:
-        lines = [item.strip() for item in file.readlines()]
-        names = lines[0].split("\t")
-        for i in range(1,len(lines)):
-            ary.append(lines[i].split("\t")[1:])
-        matrix = np.array(ary, dtype=float)
-        file.close()
+    # Calculate genetic distances, the text or binary copy is only written on request
+    matrix = distance_matrix(codes, lengths)
+    if args.distances is not None:
+        write_distance_matrix(matrix, names, args.distances)
 
     # Perform Neighbor-Joining
-    tree,par = neighbor_joining(matrix, names)
+    tree,par = neighbor_joining(matrix, list(names), args.rapid)
     edges_file = "edges.txt"
     write_tree_to_file(tree, edges_file)
 
     # Calculate the bootstrap samples
-    nd = [[0,0] for i in range(len(par)//2)]
-    m = 100 # set pseudo-replicate times
-    tmp = "tmp.txt" # set temparary file to store genetic distance 
-    for i in range(m):
-        sequences = {}
-        with open('{}'.format(fasta_file), 'r') as file:
-            lines = file.readlines()
-            anno = lines[0::2]
-            seq = lines[1::2]
-            for j in range(len(seq)):
-                seq[j] = list(str(seq[j].replace("\n",'')))
-            seq_ary = np.array(seq)
-            bs_ary = np.zeros_like(seq_ary)
-            for j in range(len(seq_ary[0])):
-                random_column_index = np.random.randint(0, seq_ary.shape[1])
-                bs_ary[:, j] = seq_ary[:, random_column_index]
-            for j in range(len(anno)):
-                sequences[anno[j].replace("\n",'').replace(">",'')] = np.array2string(bs_ary[j], separator='')
-            file.close()
-        write_genetic_distances(sequences, tmp)
-        ary = []
-        with open('{}'.format(tmp), 'r') as file:
-            lines = [item.strip() for item in file.readlines()]
-            names = lines[0].split("\t")
-            for j in range(1,len(lines)):
-                ary.append(lines[j].split("\t")[1:])
-            matrix = np.array(ary, dtype=float)
-            file.close()
-        tree_bs,par_bs = neighbor_joining(matrix, names)
-        for j in range(len(nd)):
-            nd[j][0] = len(lines) + j
-            for k in range(len(nd)):
-                if (set(par_bs[2*k].split(' ')) == set(par[2*j].split(' ')) and set(par_bs[2*k + 1].split(' ')) == set(par[2*j + 1].split(' '))) or (set(par_bs[2*k + 1].split(' ')) == set(par[2*j].split(' ')) and set(par_bs[2*k].split(' ')) == set(par[2*j + 1].split(' '))):
-                    nd[j][1] += 0.01
-                    break
-    for i in range(len(nd)):
-        nd[i][1] = round(nd[i][1],2)
+    support = bootstrap(codes, par, args.replicates, args.workers, args.seed, args.rapid)
     with open('bootstrap.txt', 'w') as file:
-        for i in nd:
-            line = '\t'.join(map(str, i)) + '\n'
+        for k, value in enumerate(support.tolist()):
+            line = '\t'.join(map(str, [len(names) + 1 + k, round(value, 2)])) + '\n'
             file.write(line)
         file.close()
-        
@@ -1,57 +1,86 @@
-from Bio import pairwise2
-from Bio.pairwise2 import format_alignment
+from Bio.Align import PairwiseAligner
+from collections import namedtuple
+import argparse
 import matplotlib.pyplot as plt
-import sys
+import numpy as np
+from matplotlib.collections import LineCollection
 
-def align_sequences(sequence_a, sequence_b):
-    alignments = pairwise2.align.globalxx(sequence_a, sequence_b, one_alignment_only=True, score_only=True)
-    alignment = pairwise2.align.globalxx(sequence_a, sequence_b, one_alignment_only=True)[0]
-    #alignment_str = format_alignment(*alignment)
-    print(format_alignment(*alignment))
+# Same fields as the Bio.pairwise2 alignments, with '-' for gaps
+Alignment = namedtuple('Alignment', ['seqA', 'seqB', 'score', 'start', 'end'])
+MAX_PLOT_POINTS = 20000
+
+def make_aligner():
+    # Scored like pairwise2.align.globalxx: matches count 1, mismatches and gaps are free
+    aligner = PairwiseAligner()
+    aligner.mode = 'global'
+    aligner.match_score = 1
+    aligner.mismatch_score = 0
+    aligner.gap_score = 0
+    return aligner
+
+def align_sequences(sequence_a, sequence_b, score_only=False, print_alignment=False):
+    # A single alignment pass; with score_only no traceback is kept and only the score is returned
+    aligner = make_aligner()
+    if score_only:
+        return aligner.score(sequence_a, sequence_b)
+    alignment = next(iter(aligner.align(sequence_a, sequence_b)))
+    if print_alignment:
+        print(alignment)
     #with open('alignment_result.txt', 'w') as result_file:
-        #result_file.write(alignment_str)
+        #result_file.write(str(alignment))
         #result_file.close()
-    return alignment
-
-def plot_alignment_coordinates(sequence_a, sequence_b, alignment):
-    a_coordinates = []
-    b_coordinates = []
-
-    a_index = 0
-    b_index = 0
-
-    for a_base, b_base in zip(alignment.seqA, alignment.seqB):
-        if a_base != '-':
-            a_coordinates.append(a_index)
-            a_index += 1
-        else:
-            a_coordinates.append(None)
-
-        if b_base != '-':
-            b_coordinates.append(b_index)
-            b_index += 1
-        else:
-            b_coordinates.append(None)
-
-    # Plotting with lines connecting the points
-    #plt.scatter(a_coordinates, b_coordinates, marker='o')
-    plt.plot(a_coordinates, b_coordinates, marker='o', markersize=1, linestyle='-', color='b', linewidth=0.2)
-    plt.xlabel('Known Location Coordinates')
-    plt.ylabel('Assembled Location Coordinates')
-    plt.title('Sequence Alignment Coordinates')
-    plt.xlim(left=0)  # Set x-axis minimum to 0
-    plt.ylim(bottom=0)  # Set y-axis minimum to 0
-    #plt.savefig('alignment_plot.png')
-    plt.show()
+    return Alignment(alignment[0], alignment[1], alignment.score, 0, alignment.shape[1])
+
+def alignment_coordinates(alignment):
+    # Position in each sequence of every alignment column (cumulative count of its non gap bases) and whether
+    # the column pairs two bases
+    present_a = np.frombuffer(alignment.seqA.encode(), dtype=np.uint8) != ord('-')
+    present_b = np.frombuffer(alignment.seqB.encode(), dtype=np.uint8) != ord('-')
+    return np.cumsum(present_a) - 1, np.cumsum(present_b) - 1, present_a & present_b
+
+def plot_alignment_coordinates(sequence_a, sequence_b, alignment, plot_file=None):
+    a_coordinates, b_coordinates, paired = alignment_coordinates(alignment)
+    columns = np.flatnonzero(paired)
+
+    # Consecutive paired columns lie on one diagonal, so every run is drawn as a single segment;
+    # the dots are thinned out to at most MAX_PLOT_POINTS
+    breaks = np.flatnonzero(np.diff(columns) != 1)
+    starts = columns[np.concatenate(([0], breaks + 1))] if len(columns) > 0 else columns
+    ends = columns[np.append(breaks, len(columns) - 1)] if len(columns) > 0 else columns
+    segments = np.stack((np.column_stack((a_coordinates[starts], b_coordinates[starts])), np.column_stack((a_coordinates[ends], b_coordinates[ends]))), axis=1)
+    dots = columns[::max(1, len(columns) // MAX_PLOT_POINTS)]
+
+    figure, axes = plt.subplots()
+    axes.add_collection(LineCollection(segments, colors='b', linewidths=0.5))
+    axes.plot(a_coordinates[dots], b_coordinates[dots], marker='o', markersize=1, linestyle='none', color='b')
+    axes.autoscale_view()
+    axes.set_xlabel('Known Location Coordinates')
+    axes.set_ylabel('Assembled Location Coordinates')
+    axes.set_title('Sequence Alignment Coordinates')
+    axes.set_xlim(left=0)  # Set x-axis minimum to 0
+    axes.set_ylim(bottom=0)  # Set y-axis minimum to 0
+    if plot_file is not None:
+        figure.savefig(plot_file)
+        plt.close(figure)
+    else:
+        plt.show()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python plot_assemble.py sequences_file; sequences_file should only contains 2 lines, each line is a pure DNA sequence.")
-        sys.exit(1)
-    with open(sys.argv[1], "r") as file:
+    parser = argparse.ArgumentParser(description="Align two sequences and plot the coordinates of the aligned bases.")
+    parser.add_argument('sequences_file', type=str, help='File of 2 lines, each line is a pure DNA sequence')
+    parser.add_argument('--score-only', action='store_true', help='Only print the alignment score, without traceback or plot')
+    parser.add_argument('--print-alignment', action='store_true', help='Print the whole alignment before plotting')
+    parser.add_argument('--plot-file', type=str, help="Save the plot to this file (e.g. 'alignment_plot.png') without opening a window")
+    args = parser.parse_args()
+    if args.plot_file is not None:
+        plt.switch_backend('Agg')
+    with open(args.sequences_file, "r") as file:
         lines = file.readlines()
         file.close()
-    sequence_a = lines[1]
-    sequence_b = lines[0]
-    alignment = align_sequences(sequence_a, sequence_b)
-    plot_alignment_coordinates(sequence_a, sequence_b, alignment)
+    sequence_a = lines[1].strip()
+    sequence_b = lines[0].strip()
+    if args.score_only:
+        print(align_sequences(sequence_a, sequence_b, score_only=True))
+    else:
+        alignment = align_sequences(sequence_a, sequence_b, print_alignment=args.print_alignment)
+        plot_alignment_coordinates(sequence_a, sequence_b, alignment, args.plot_file)